@@ -0,0 +1,17 @@
+# api/dependencies.py
+from fastapi import Request
+from services.lead_service import LeadService
+from services.firebase_service import FirebaseService
+from services.retell_service import RetellService
+
+def get_lead_service(request: Request) -> LeadService:
+    """App-scoped LeadService created in the lifespan (shares one Firestore client and one Retell HTTP pool)"""
+    return request.app.state.lead_service
+
+def get_firebase_service(request: Request) -> FirebaseService:
+    """Process-wide FirebaseService registered in the lifespan"""
+    return request.app.state.firebase_service
+
+def get_retell_service(request: Request) -> RetellService:
+    """Process-wide RetellService (one httpx connection pool) registered in the lifespan"""
+    return request.app.state.retell_service
@@ -0,0 +1,23 @@
+# api/orjson_route.py
+from typing import Any, Callable
+import orjson
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+class ORJSONRequest(Request):
+    """Request whose JSON body is decoded with orjson instead of the stdlib json module"""
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            # orjson.JSONDecodeError subclasses json.JSONDecodeError, so FastAPI still answers 422 on bad bodies
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    """APIRoute that hands endpoints an ORJSONRequest, so request bodies are parsed by orjson"""
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def orjson_route_handler(request: Request) -> Response:
+            return await original_route_handler(ORJSONRequest(request.scope, request.receive))
+
+        return orjson_route_handler
@@ -1,76 +1,131 @@
 # api/routes.py
-from fastapi import APIRouter, HTTPException, UploadFile, File, BackgroundTasks
+from fastapi import APIRouter, HTTPException, UploadFile, File, BackgroundTasks, Request, Depends
 from fastapi.responses import JSONResponse
 from typing import Dict, Any, List
 import logging
+import asyncio
+import msgspec
+from google.api_core.exceptions import AlreadyExists
 from services.lead_service import LeadService
-from utils.csv_parser import CSVParser
-from models.lead_models import Lead, CallWebhookEvent
-import datetime
+from services.firebase_service import FirebaseService
+from services.retell_service import RetellService
+from utils.csv_parser import CSVParser, CSVParseError
+from utils.ttl_cache import SingleFlightTTL
+from models.lead_models import Lead, CallWebhookEvent, CallStatus
+from api.orjson_route import ORJSONRoute
+from api.dependencies import get_lead_service, get_firebase_service, get_retell_service
+from config.settings import settings
+from datetime import datetime
 
-# Initialize router and services
-router = APIRouter(prefix="/api/v1")
-lead_service = LeadService()
+# Initialize router and helpers (services are app-scoped, see api/dependencies.py)
+router = APIRouter(prefix="/api/v1", route_class=ORJSONRoute) # Request bodies are decoded with orjson
 csv_parser = CSVParser()
+# Dashboards poll the stats endpoints; collapse bursts into one Firestore aggregation per TTL
+# (Retell concurrency is cached inside RetellService)
+lead_stats_cache = SingleFlightTTL(settings.lead_stats_cache_ttl_seconds)
 logger = logging.getLogger(__name__)
 
+def _upload_result(lead_ids: List[str], skipped_rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Response body for an upload: created lead IDs plus every row that was dropped and why"""
+    return {
+        "lead_ids": lead_ids,
+        "skipped_count": len(skipped_rows),
+        "skipped_rows": skipped_rows
+    }
+
 @router.post("/upload-leads")
-async def upload_leads(file: UploadFile = File(...)):
-    """Upload CSV file with leads"""
+async def upload_leads(file: UploadFile = File(...), lead_service: LeadService = Depends(get_lead_service)):
+    """
+    Upload CSV file with leads.
+    Leads are written chunk by chunk, so if the file fails mid-stream the leads already created stay:
+    the response is then a partial success carrying their IDs and where parsing stopped.
+    """
+    lead_ids: List[str] = []
+    skipped_rows: List[Dict[str, Any]] = []
     try:
         if not file.filename.endswith('.csv'):
             raise HTTPException(status_code=400, detail="File must be a CSV")
         
-        # Read file content
-        content = await file.read()
-        csv_content = content.decode('utf-8')
-        
-        # Parse CSV
-        records = await csv_parser.parse_csv_content(csv_content)
+        # Reject oversized uploads before any parsing work is dispatched
+        if file.size is not None and file.size > settings.max_upload_size_bytes:
+            raise HTTPException(status_code=413, detail=f"File exceeds {settings.max_upload_size_bytes} bytes")
         
-        # Validate required fields
+        # Fail fast on the header alone, before any rows are parsed
         required_fields = ['phone_number']
-        if not csv_parser.validate_required_fields(records, required_fields):
-            raise HTTPException(status_code=400, detail="Missing required fields in CSV")
+        headers = csv_parser.peek_header(file.file)
+        missing_fields = [field for field in required_fields if field not in headers]
+        if missing_fields:
+            raise HTTPException(status_code=400, detail=f"Missing required fields in CSV: {', '.join(missing_fields)}")
+        
+        # Stream and parse the upload chunk by chunk instead of buffering the whole file
+        record_chunks = csv_parser.parse_stream(
+            file.file, required_fields,
+            chunk_size=lead_service.firebase_service.BATCH_WRITE_LIMIT,
+            skipped=skipped_rows
+        )
         
         # Process leads
-        lead_ids = await lead_service.process_csv_leads(records)
+        await lead_service.process_csv_leads(record_chunks, lead_ids=lead_ids, skipped=skipped_rows)
         
         return {
             "status": "success",
             "message": f"Successfully uploaded {len(lead_ids)} leads",
-            "lead_ids": lead_ids
+            **_upload_result(lead_ids, skipped_rows)
         }
         
     except HTTPException:
         raise
+    except (CSVParseError, UnicodeDecodeError) as e:
+        rows_read = getattr(e, 'rows_read', 0)
+        if not lead_ids:
+            raise HTTPException(status_code=400, detail=f"Invalid CSV (after {rows_read} rows): {str(e)}")
+        return {
+            "status": "partial_success",
+            "message": f"Uploaded {len(lead_ids)} leads before the CSV failed to parse after {rows_read} rows",
+            "error": {"detail": str(e), "rows_read": rows_read},
+            **_upload_result(lead_ids, skipped_rows)
+        }
     except Exception as e:
-        logger.error(f"Error uploading leads: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal server error")
+        logger.error(f"Error uploading leads after creating {len(lead_ids)} leads: {str(e)}")
+        if not lead_ids:
+            raise HTTPException(status_code=500, detail="Internal server error")
+        return {
+            "status": "partial_success",
+            "message": f"Uploaded {len(lead_ids)} leads before an internal error stopped the upload",
+            "error": {"detail": "Internal server error"},
+            **_upload_result(lead_ids, skipped_rows)
+        }
 
 @router.post("/webhook/retell")
-async def receive_retell_webhook(webhook_data: Dict[str, Any]):
+async def receive_retell_webhook(request: Request, lead_service: LeadService = Depends(get_lead_service)):
     """Receive webhook events from Retell API"""
     try:
-        logger.info(f"Received webhook: {webhook_data.get('event_type')}")
+        # Decode and validate the raw body straight into the msgspec struct
+        try:
+            event = msgspec.json.decode(await request.body(), type=CallWebhookEvent)
+        except (msgspec.DecodeError, msgspec.ValidationError) as e:
+            raise HTTPException(status_code=422, detail=f"Invalid webhook payload: {str(e)}")
+        
+        logger.info(f"Received webhook: {event.event_type}")
         
         # Process the webhook
-        success = await lead_service.process_call_webhook(webhook_data)
+        success = await lead_service.process_call_webhook(event)
         
         if success:
             return {"status": "success", "message": "Webhook processed successfully"}
         else:
             raise HTTPException(status_code=400, detail="Failed to process webhook")
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.post("/leads")
-async def create_lead(lead: Lead):
+async def create_lead(lead: Lead, firebase_service: FirebaseService = Depends(get_firebase_service)):
     """Create a single lead"""
     try:
-        firebase_service = lead_service.firebase_service
         lead_id = await firebase_service.create_lead(lead)
         
         return {
@@ -79,21 +134,23 @@ async def create_lead(lead: Lead):
             "lead_id": lead_id
         }
         
+    except AlreadyExists:
+        raise HTTPException(status_code=409, detail="A lead with this phone number already exists")
     except Exception as e:
         logger.error(f"Error creating lead: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/leads/{lead_id}")
-async def get_lead(lead_id: str):
+async def get_lead(lead_id: str, firebase_service: FirebaseService = Depends(get_firebase_service)):
     """Get a specific lead by ID"""
     try:
-        firebase_service = lead_service.firebase_service
         lead = await firebase_service.get_lead(lead_id)
         
         if not lead:
             raise HTTPException(status_code=404, detail="Lead not found")
         
-        return lead.model_dump()
+        # JSON mode renders the epoch-ms timestamps as ISO strings
+        return lead.model_dump(mode='json')
         
     except HTTPException:
         raise
@@ -102,7 +159,7 @@ async def get_lead(lead_id: str):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.post("/manual-call-batch")
-async def trigger_manual_call_batch(background_tasks: BackgroundTasks):
+async def trigger_manual_call_batch(background_tasks: BackgroundTasks, lead_service: LeadService = Depends(get_lead_service)):
     """Manually trigger a calling batch (for testing)"""
     try:
         background_tasks.add_task(lead_service.execute_calling_batch)
@@ -117,10 +174,9 @@ async def trigger_manual_call_batch(background_tasks: BackgroundTasks):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/stats/concurrency")
-async def get_concurrency_stats():
+async def get_concurrency_stats(retell_service: RetellService = Depends(get_retell_service)):
     """Get current Retell API concurrency information"""
     try:
-        retell_service = lead_service.retell_service
         concurrency_info = await retell_service.get_concurrency()
         
         if not concurrency_info:
@@ -135,35 +191,35 @@ async def get_concurrency_stats():
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/stats/leads")
-async def get_lead_stats():
+async def get_lead_stats(firebase_service: FirebaseService = Depends(get_firebase_service)):
     """Get lead statistics"""
     try:
-        firebase_service = lead_service.firebase_service
-        
-        # Get counts from different collections
-        stats = {
-            "total_leads": 0,
-            "new_calls": 0,
-            "retry_calls": 0,
-            "callback_calls": 0,
-            "completed_calls": 0,
-            "failed_calls": 0
-        }
-        
-        # Count documents in each collection
-        # Note: In production, you might want to use more efficient counting methods
-        
-        return stats
+        return await lead_stats_cache.get("lead_stats", lambda: _load_lead_stats(firebase_service))
         
     except Exception as e:
         logger.error(f"Error getting lead stats: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+async def _load_lead_stats(firebase_service: FirebaseService) -> Dict[str, Any]:
+    """Aggregate lead statistics from Firestore (served through lead_stats_cache)"""
+    # One count() aggregation per status plus the total, all dispatched concurrently
+    statuses = list(CallStatus)
+    total, *status_counts = await asyncio.gather(
+        firebase_service.count_by_status(),
+        *[firebase_service.count_by_status(status) for status in statuses]
+    )
+    
+    stats = {"total_leads": total}
+    for status, count in zip(statuses, status_counts):
+        stats[f"{status.value}_calls"] = count
+    
+    return stats
+
 @router.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": datetime.now(settings.app_timezone_obj),
         "service": "Lead Management Backend"
     }
@@ -1,34 +1,56 @@
 # app.py
+import asyncio
 import logging
+import queue
 import uvicorn
+from logging.handlers import QueueHandler, QueueListener
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from api.routes import router
 from utils.scheduler import CallScheduler
+from services.lead_service import LeadService
+from services.firebase_service import FirebaseService
+from services.retell_service import RetellService
 from config.settings import settings
 
-# Configure logging
+# Configure logging: request handlers only enqueue records; a background thread does the file/console I/O
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler('app.log')
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
 
 logger = logging.getLogger(__name__)
 
-# Global scheduler instance
-scheduler = CallScheduler()
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifespan events"""
+    lead_service = None
+    scheduler = None
+    # Shared pool for asyncio.to_thread, sized so concurrent blocking work doesn't queue behind the default pool
+    executor = ThreadPoolExecutor(max_workers=settings.blocking_io_workers, thread_name_prefix="blocking-io")
+    asyncio.get_running_loop().set_default_executor(executor)
     try:
-        # Startup
+        # Startup: build service clients inside the running loop and share them app-wide
         logger.info("Starting Lead Management Backend...")
+        # One Firestore client (and gRPC channel) for the whole process
+        app.state.firebase_service = FirebaseService.get_instance()
+        # One Retell HTTP connection pool, shared by the dialer and the API routes
+        app.state.retell_service = RetellService.get_instance()
+        lead_service = LeadService()
+        app.state.lead_service = lead_service
+        scheduler = CallScheduler(lead_service)
         await scheduler.start_scheduler()
         logger.info("Application started successfully")
         
@@ -40,21 +62,29 @@ async def lifespan(app: FastAPI):
     finally:
         # Shutdown
         logger.info("Shutting down application...")
-        await scheduler.stop_scheduler()
+        if scheduler is not None:
+            await scheduler.stop_scheduler()
+        if lead_service is not None:
+            await lead_service.retell_service.close()
+            await lead_service.firebase_service.close()
+        executor.shutdown(wait=False)
         logger.info("Application shutdown complete")
+        # Flush queued log records to their handlers
+        log_listener.stop()
 
 # Create FastAPI application
 app = FastAPI(
     title="Lead Management Backend",
     description="AI-powered lead calling system with Retell API integration",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure appropriately for production
+    allow_origins=settings.cors_origins,  # Explicit allow-list; a wildcard with credentials echoes any origin
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -73,10 +103,24 @@ async def root():
     }
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "app:app",
-        host=settings.app_host,
-        port=settings.app_port,
-        reload=True,
-        log_level="info"
-    )
+    if settings.debug:
+        uvicorn.run(
+            "app:app",
+            host=settings.app_host,
+            port=settings.app_port,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        # loop/http "auto" pick uvloop and httptools when installed (neither supports Windows).
+        # Equivalent gunicorn setup:
+        #   gunicorn app:app -k uvicorn.workers.UvicornWorker -w <workers> -b 0.0.0.0:8000
+        uvicorn.run(
+            "app:app",
+            host=settings.app_host,
+            port=settings.app_port,
+            workers=settings.workers,
+            loop="auto",
+            http="auto",
+            log_level="info"
+        )
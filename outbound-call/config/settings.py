@@ -1,9 +1,10 @@
 # config/settings.py
 import os
-from typing import Optional
+from datetime import timezone, tzinfo
+from functools import cached_property
+from typing import List, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from pydantic_settings import BaseSettings
-from pydantic import Field # Import Field for excluding from validation
-import pytz
 
 class Settings(BaseSettings):
     # Firebase
@@ -17,13 +18,21 @@ class Settings(BaseSettings):
     retell_webhook_secret: Optional[str] = None
     retell_agent_id: str
     retell_phone_number: str
+    default_phone_region: str = "IN"  # Region assumed for lead numbers without a country code
 
     # Application
     app_host: str = "0.0.0.0"
     app_port: int = 8000
     webhook_base_url: str  # Your public URL for webhooks
+    # Browser origins allowed to call the API (JSON list in env, e.g. CORS_ORIGINS='["https://app.example.com"]')
+    cors_origins: List[str] = ["http://localhost:5173"]  # Vite dev server
+    debug: bool = False  # Single process with auto-reload when true
+    workers: int = 2 * (os.cpu_count() or 1) + 1
+    scheduler_lock_path: str = "scheduler.lock"  # Elects the one worker that runs scheduled jobs
     
     # Calling configuration
+    retell_rps: float = 2  # Sustained call initiations per second
+    retell_burst: int = 5  # Call initiations allowed back-to-back before pacing kicks in
     max_concurrent_calls: int = 15
     max_retries: int = 3
     cron_interval_minutes: int = 10
@@ -31,20 +40,42 @@ class Settings(BaseSettings):
     calling_end_hour: int = 17    # 11 PM (originally 5 PM, changed to 11 PM based on common calling hours)
     calling_end_minute: int = 30  # 5:30 PM (now 11:30 PM)
     
+    # Lead uploads
+    max_upload_size_bytes: int = 50 * 1024 * 1024
+    
+    # Caching (seconds)
+    concurrency_fresh_seconds: float = 3   # Retell concurrency served from cache
+    concurrency_stale_seconds: float = 10  # ...then served stale while refreshing in the background
+    lead_stats_cache_ttl_seconds: float = 30
+    lead_cache_ttl_seconds: float = 5  # get_lead / phone-number lookups
+    lead_cache_max_entries: int = 10_000
+    webhook_dedupe_ttl_seconds: float = 300  # Retried Retell webhooks for an applied call_id are skipped (per worker process)
+    webhook_dedupe_max_entries: int = 10_000
+    
+    # Lead update coalescing: updates arriving within the window are committed as one write batch
+    lead_update_batch_max: int = 50
+    lead_update_batch_window_ms: float = 50
+    
+    # Worker threads behind asyncio.to_thread (CSV parsing and lead validation run there)
+    blocking_io_workers: int = 40
+    
+    # Leads created before document IDs were derived from the E.164 number have random IDs. Until
+    # scripts/rekey_legacy_leads.py has been run, new leads are also checked against them with a phone query
+    legacy_lead_dedupe: bool = True
+    
     app_timezone: str = os.getenv("APP_TIMEZONE", "Asia/Kolkata")
     
-    # FIX: Use Field(None, exclude=True) to tell Pydantic to ignore this field during initial validation
-    app_timezone_obj: Optional[pytz.timezone] = Field(None, exclude=True)
+    @cached_property
+    def app_timezone_obj(self) -> tzinfo:
+        """Timezone object for app_timezone, resolved once on first access (stdlib zoneinfo, C-backed)"""
+        try:
+            return ZoneInfo(self.app_timezone)
+        except (ZoneInfoNotFoundError, ValueError):
+            print(f"Warning: Unknown timezone '{self.app_timezone}'. Falling back to UTC.")
+            return timezone.utc
 
     class Config:
         env_file = ".env"
 
 # Create an instance of Settings
 settings = Settings()
-
-# Post-initialization to set the timezone object
-try:
-    settings.app_timezone_obj = pytz.timezone(settings.app_timezone)
-except pytz.UnknownTimeZoneError:
-    print(f"Warning: Unknown timezone '{settings.app_timezone}'. Falling back to UTC.")
-    settings.app_timezone_obj = pytz.utc
\ No newline at end of file
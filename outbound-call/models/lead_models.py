@@ -1,8 +1,23 @@
 # models/lead_models.py
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator, field_serializer
 from typing import Optional, Dict, Any
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
+import time
+import logging
+import msgspec
+import orjson
+from utils.phone import normalize_phone_number
+
+logger = logging.getLogger(__name__)
+
+def now_ms() -> int:
+    """Current time as integer epoch milliseconds"""
+    return time.time_ns() // 1_000_000
+
+def to_iso(ms: int) -> str:
+    """Convert epoch milliseconds to an ISO-8601 UTC string for API responses"""
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat()
 
 class CallStatus(str, Enum):
     NEW = "new"
@@ -11,6 +26,7 @@ class CallStatus(str, Enum):
     RETRY = "retry"
     CALLBACK = "callback"
     FAILED = "failed"
+    OPTED_OUT = "opted_out"
 
 class DisconnectionReason(str, Enum):
     USER_HANGUP = "user_hangup"
@@ -27,7 +43,7 @@ class Lead(BaseModel):
     name: Optional[str] = None
     email: Optional[str] = None
     company: Optional[str] = None
-    custom_data: Optional[Dict[str, Any]] = {}
+    custom_data: Optional[Dict[str, Any]] = Field(default_factory=dict)
     priority: int = 0
     priority_reason: Optional[str] = None
 
@@ -38,33 +54,93 @@ class Lead(BaseModel):
     callback_time: Optional[datetime] = None
     
     # Call result data
-    post_call_data: Optional[Dict[str, Any]] = {}
-    call_recordings: Optional[list] = []
+    post_call_data: Optional[Dict[str, Any]] = Field(default_factory=dict)
+    call_recordings: Optional[list] = Field(default_factory=list)
     
-    created_at: datetime = Field(default_factory=datetime.now)
-    updated_at: datetime = Field(default_factory=datetime.now)
+    # Epoch milliseconds; cheaper to build per row than datetime objects during bulk ingest
+    created_at: int = Field(default_factory=now_ms)
+    updated_at: int = Field(default_factory=now_ms)
+
+    @field_validator('phone_number')
+    @classmethod
+    def _normalize_phone_number(cls, value: str) -> str:
+        # Lead document IDs are derived from the E.164 number, so every validated Lead carries that form
+        # (CSV rows are normalized by the parser and built with model_construct, skipping this)
+        normalized = normalize_phone_number(value)
+        if normalized is None:
+            raise ValueError("invalid phone number")
+        return normalized
+
+    @field_validator('created_at', 'updated_at', mode='before')
+    @classmethod
+    def _datetime_to_ms(cls, value: Any) -> Any:
+        # Documents written with SERVER_TIMESTAMP come back from Firestore as datetimes
+        if isinstance(value, datetime):
+            return int(value.timestamp() * 1000)
+        return value
+
+    @field_serializer('created_at', 'updated_at', when_used='json')
+    def _ms_to_iso(self, value: int) -> str:
+        return to_iso(value)
 
-class CallWebhookEvent(BaseModel):
+    @classmethod
+    def from_firestore(cls, doc_id: str, data: Dict[str, Any]) -> "Lead":
+        """
+        Build a Lead from a stored document without full validation (documents are written by this service).
+        Only the conversions the rest of the code relies on are applied: call_status enum and ms timestamps.
+        """
+        data = {k: v for k, v in data.items() if k in cls.model_fields}
+        data['id'] = doc_id
+        if 'call_status' in data:
+            data['call_status'] = CallStatus(data['call_status'])
+        for key in ('created_at', 'updated_at'):
+            if key in data:
+                data[key] = cls._datetime_to_ms(data[key])
+        return cls.model_construct(**data)
+
+# Keyword arguments for dumping a Lead into a Firestore document: unset/default fields
+# (empty custom_data, call_recordings, priority_reason, ...) are left out of the stored document.
+LEAD_DUMP_KW = dict(exclude_none=True, exclude_defaults=True, mode='python')
+
+class CallWebhookEvent(msgspec.Struct, omit_defaults=True):
+    """
+    Retell webhook payload. A msgspec Struct rather than a pydantic model: the webhook is the
+    highest-volume inbound path, and msgspec decodes and validates the JSON bytes in a single pass.
+    """
     event_type: str
     call_id: str
-    agent_id: str
-    call_type: str
-    phone_number: str
-    from_number: str
-    to_number: str
-    direction: str
-    call_status: str
+    # Not every Retell event carries the full call metadata
+    agent_id: Optional[str] = None
+    call_type: Optional[str] = None
+    phone_number: Optional[str] = None
+    from_number: Optional[str] = None
+    to_number: Optional[str] = None
+    direction: Optional[str] = None
+    call_status: Optional[str] = None
     start_timestamp: Optional[int] = None
     end_timestamp: Optional[int] = None
     disconnection_reason: Optional[str] = None
     recording_url: Optional[str] = None
     public_log_url: Optional[str] = None
-    llm_dynamic_variables: Optional[Dict[str, Any]] = {}
+    llm_dynamic_variables: Optional[Dict[str, Any]] = msgspec.field(default_factory=dict)
     opt_out_sensitive_data_storage: Optional[bool] = False
 
 class RetellCreateCallRequest(BaseModel):
     from_number: str
     to_number: str
     override_agent_id: Optional[str] = None
-    retell_llm_dynamic_variables: Optional[Dict[str, Any]] = {}
+    retell_llm_dynamic_variables: Optional[Dict[str, Any]] = Field(default_factory=dict)
     drop_call_if_machine_detected: bool = True
+
+    @field_validator('retell_llm_dynamic_variables')
+    @classmethod
+    def _stringify_custom_data(cls, value: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # Retell dynamic variables must be strings, so custom_data is sent as a JSON-encoded string
+        if value and 'custom_data' in value and not isinstance(value['custom_data'], str):
+            custom_data = value['custom_data']
+            try:
+                value['custom_data'] = orjson.dumps(custom_data).decode()
+            except TypeError: # orjson.JSONEncodeError subclasses TypeError
+                logger.warning("custom_data is not JSON serializable (%s), sending empty JSON object as string: %s", type(custom_data), custom_data)
+                value['custom_data'] = "{}"
+        return value
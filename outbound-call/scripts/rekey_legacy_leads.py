@@ -0,0 +1,25 @@
+# scripts/rekey_legacy_leads.py
+"""
+One-off migration: move leads created with random document IDs to the ID derived from their E.164 phone number,
+so create()/bulk uploads dedupe against them. Run from the outbound-call directory:
+
+    python -m scripts.rekey_legacy_leads
+
+Once it reports no remaining duplicates or invalid numbers, set LEGACY_LEAD_DEDUPE=false to drop the
+per-create phone-number fallback query.
+"""
+import asyncio
+import logging
+from services.firebase_service import FirebaseService
+
+async def main() -> None:
+    firebase_service = FirebaseService.get_instance()
+    try:
+        stats = await firebase_service.rekey_legacy_leads()
+        print(f"Rekey complete: {stats}")
+    finally:
+        await firebase_service.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
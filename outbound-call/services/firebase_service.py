@@ -1,21 +1,73 @@
 # services/firebase_service.py
 import firebase_admin
-from firebase_admin import credentials, firestore
-from typing import List, Dict, Any, Optional
+from firebase_admin import credentials, firestore, firestore_async
+from typing import List, Dict, Any, Optional, AsyncIterator, Iterable, Tuple
 import logging
 from datetime import datetime, date, timedelta
 from config.settings import settings
 import asyncio 
-from models.lead_models import Lead, CallStatus 
+import xxhash
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore import async_transactional
+from models.lead_models import Lead, CallStatus, LEAD_DUMP_KW
+from utils.ttl_cache import SingleFlightTTL
+from utils.phone import normalize_phone_number, legacy_phone_number_forms
+
+# Fields every newly created lead document starts with (applied over the dumped Lead)
+_NEW_LEAD_DEFAULTS = {
+    'created_at': firestore.SERVER_TIMESTAMP,
+    'updated_at': firestore.SERVER_TIMESTAMP,
+    'call_status': CallStatus.NEW.value,
+    'number_of_retries': 0,
+    'last_call_time': None,
+    'callback_time': None,
+    'retry_date': None,
+}
+
+class PageCursor:
+    """Paging position of one consumer of a paged query (each calling batch holds its own)"""
+    def __init__(self):
+        self.last_doc = None # Last document of the most recent page read in full
+        self.exhausted = False # Set once a short page (or an abandoned one) ends the paging
 
 class FirebaseService:
+    # Process-wide instance; see get_instance()
+    _instance: Optional["FirebaseService"] = None
+
+    @classmethod
+    def get_instance(cls) -> "FirebaseService":
+        """Return the shared FirebaseService, creating it (and its Firestore client/channel) on first use"""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self._initialize_firebase()
-        # self.db is the synchronous Firestore client
-        self.db = firestore.client() 
+        # self.db is the asyncio Firestore client: every call is awaited directly on the event loop
+        self.db = firestore_async.client() 
         
         self.LEADS_COLLECTION = "leads"
+        # retell_call_id -> lead_id, so webhooks resolve their lead with one keyed read
+        self.CALL_INDEX_COLLECTION = "call_index"
+        # Reused collection reference and call_status filters (built once instead of per query)
+        self._leads = self.db.collection(self.LEADS_COLLECTION)
+        self._filter_new = firestore.FieldFilter('call_status', '==', CallStatus.NEW.value)
+        self._filter_callback = firestore.FieldFilter('call_status', '==', CallStatus.CALLBACK.value)
+        self._filter_retry = firestore.FieldFilter('call_status', '==', CallStatus.RETRY.value)
+        # Firestore rejects write batches with more than 500 operations
+        self.BATCH_WRITE_LIMIT = 500
+        # Documents per page when a query is drained with a start_after cursor
+        self.QUERY_PAGE_SIZE = 500
+        # Concurrent create() RPCs per bulk_create_leads call
+        self.CREATE_CONCURRENCY = 100
+        # Short-lived caches for repeated lookups of the same lead: lead_id -> Lead, phone_number -> lead_id
+        self._lead_cache = SingleFlightTTL(settings.lead_cache_ttl_seconds, maxsize=settings.lead_cache_max_entries)
+        self._phone_cache = SingleFlightTTL(settings.lead_cache_ttl_seconds, maxsize=settings.lead_cache_max_entries)
+        # Lead update coalescer (queue of (lead_id, patch, future)); the worker starts on first use
+        self._update_queue: Optional[asyncio.Queue] = None
+        self._update_worker: Optional[asyncio.Task] = None
+        self._closed = False # Set by close(); later updates are rejected instead of queued
         
     def _initialize_firebase(self):
         """Initialize Firebase Admin SDK (synchronous)"""
@@ -27,71 +79,32 @@ class FirebaseService:
                 })
             self.logger.info("Firebase initialized successfully")
         except Exception as e:
-            self.logger.error(f"Failed to initialize Firebase: {str(e)}")
+            self.logger.error("Failed to initialize Firebase: %s", e)
             raise
     
-    # All methods that interact with self.db need to use asyncio.to_thread
+    # All methods that interact with self.db await the AsyncClient's coroutines / async streams
     
     async def create_lead(self, lead: Lead) -> str:
-        """Create a new lead in Firestore (synchronous operation run in thread)"""
+        """Create a new lead in Firestore"""
         try:
-            lead_dict = lead.model_dump(exclude_none=True)
-            lead_dict['created_at'] = firestore.SERVER_TIMESTAMP
-            lead_dict['updated_at'] = firestore.SERVER_TIMESTAMP
-            lead_dict['call_status'] = CallStatus.NEW.value
-            lead_dict['number_of_retries'] = 0
-            lead_dict['last_call_time'] = None 
-            lead_dict['callback_time'] = None 
-            lead_dict['retry_date'] = None
+            lead_dict = {**lead.model_dump(**LEAD_DUMP_KW), **_NEW_LEAD_DEFAULTS}
             
-            # Use asyncio.to_thread to run the blocking Firestore call
-            doc_ref = await asyncio.to_thread(self.db.collection(self.LEADS_COLLECTION).document)
-            await asyncio.to_thread(doc_ref.set, lead_dict) 
+            if settings.legacy_lead_dedupe and await self._legacy_phone_numbers([lead.phone_number]):
+                raise AlreadyExists(f"A lead with phone number {lead.phone_number} already exists")
+            
+            # Same phone-number-derived ID as bulk uploads; create() raises AlreadyExists for a duplicate
+            doc_ref = self._leads.document(self.lead_doc_id(lead.phone_number))
+            await doc_ref.create(lead_dict) 
             
             lead_id = doc_ref.id
             
-            self.logger.info(f"Created lead with ID: {lead_id}")
+            self.logger.info("Created lead with ID: %s", lead_id)
             return lead_id
             
         except Exception as e:
-            self.logger.error(f"Error creating lead: {str(e)}")
+            self.logger.error("Error creating lead: %s", e)
             raise
     
-    # async def bulk_create_leads(self, leads: List[Lead]) -> List[str]:
-        """Create multiple leads in batch (synchronous operation run in thread)"""
-        try:
-            if not leads:
-                self.logger.info("No leads to bulk create.")
-                return []
-
-            # Create the batch object synchronously
-            batch = self.db.batch()
-            lead_ids = []
-            
-            for lead in leads:
-                lead_dict = lead.model_dump(exclude_none=True)
-                lead_dict['created_at'] = firestore.SERVER_TIMESTAMP
-                lead_dict['updated_at'] = firestore.SERVER_TIMESTAMP
-                lead_dict['call_status'] = CallStatus.NEW.value
-                lead_dict['number_of_retries'] = 0
-                lead_dict['last_call_time'] = None
-                lead_dict['callback_time'] = None
-                lead_dict['retry_date'] = None
-                
-                # Get document reference synchronously
-                doc_ref = self.db.collection(self.LEADS_COLLECTION).document()
-                batch.set(doc_ref, lead_dict)
-                lead_ids.append(doc_ref.id)
-                
-            # --- This is the key change: AWAITING the synchronous batch.commit() operation ---
-            await asyncio.to_thread(batch.commit)
-            self.logger.info(f"Created {len(lead_ids)} leads in batch")
-            return lead_ids
-            
-        except Exception as e:
-            self.logger.error(f"Error in bulk create leads: {str(e)}")
-            raise
-
 ##################################################################
     async def get_lead_by_phone_number(self, phone_number: str) -> Optional[Lead]:
         """
@@ -99,297 +112,612 @@ class FirebaseService:
         Since phone numbers are indexed, this should be efficient.
         """
         try:
-            # Firestore doesn't enforce uniqueness, so it's possible to have multiple.
-            # We'll just take the first one found.
-            query = (self.db.collection(self.LEADS_COLLECTION)
-                     .where(filter=firestore.FieldFilter('phone_number', '==', phone_number))
-                     .limit(1))
-            
-            # Run the synchronous query in a thread
-            docs_stream = await asyncio.to_thread(query.stream)
-            
-            for doc in docs_stream:
-                data = doc.to_dict()
-                data['id'] = doc.id
-                return Lead(**data)
-            return None # No lead found
+            # Resolve the ID (cached); on a miss the lookup query also fills the get_lead cache,
+            # so get_lead below is served from memory instead of a second RPC
+            lead_id = await self._phone_cache.get(phone_number, lambda: self._find_lead_id_by_phone_number(phone_number))
+            return await self.get_lead(lead_id) if lead_id else None
         except Exception as e:
-            self.logger.error(f"Error getting lead by phone number {phone_number}: {str(e)}")
+            self.logger.error("Error getting lead by phone number %s: %s", phone_number, e)
             raise
 
+    async def _find_lead_id_by_phone_number(self, phone_number: str) -> Optional[str]:
+        """ID of the first lead with this phone number; the full document read is cached for get_lead"""
+        query = (self._leads
+                 .where(filter=firestore.FieldFilter('phone_number', '==', phone_number))
+                 .limit(1))
+        async for doc in query.stream():
+            self._lead_cache.put(doc.id, Lead.from_firestore(doc.id, doc.to_dict()))
+            return doc.id
+        return None
+
+    async def _legacy_phone_numbers(self, phone_numbers: List[str]) -> set:
+        """
+        The subset of these E.164 numbers that already have a lead stored under a random (pre-rekey) document ID,
+        matched on the E.164 or bare national form. Queries run concurrently, 30 values per 'in' filter.
+        """
+        forms = {form: phone_number for phone_number in phone_numbers for form in legacy_phone_number_forms(phone_number)}
+        values = list(forms)
+        
+        async def _matches(chunk: List[str]) -> List[str]:
+            query = self._leads.where(filter=firestore.FieldFilter('phone_number', 'in', chunk)).select(['phone_number'])
+            return [doc.get('phone_number') async for doc in query.stream()]
+        
+        results = await asyncio.gather(*(_matches(values[i:i + 30]) for i in range(0, len(values), 30)))
+        return {forms[value] for matches in results for value in matches if value in forms}
+
+    async def rekey_legacy_leads(self) -> Dict[str, int]:
+        """
+        One-off migration: move every lead whose document ID isn't lead_doc_id(E.164 number) to that ID,
+        storing the number in E.164 and repointing its call_index entries. A lead whose target ID is already
+        taken (a duplicate) or whose number can't be normalized is left in place and counted for manual review.
+        """
+        stats = {'scanned': 0, 'rekeyed': 0, 'duplicates': 0, 'invalid': 0}
+        call_index = self.db.collection(self.CALL_INDEX_COLLECTION)
+        last_doc = None
+        while True:
+            query = self._leads.order_by('__name__').limit(self.QUERY_PAGE_SIZE)
+            if last_doc is not None:
+                query = query.start_after(last_doc)
+            docs = [doc async for doc in query.stream()]
+            if not docs:
+                break
+            last_doc = docs[-1]
+            for doc in docs:
+                stats['scanned'] += 1
+                data = doc.to_dict()
+                phone_number = normalize_phone_number(str(data.get('phone_number', '')))
+                if phone_number is None:
+                    stats['invalid'] += 1
+                    self.logger.warning("Lead %s has an invalid phone number %r; not rekeyed", doc.id, data.get('phone_number'))
+                    continue
+                new_id = self.lead_doc_id(phone_number)
+                if doc.id == new_id:
+                    continue
+                
+                batch = self.db.batch()
+                batch.create(self._leads.document(new_id), {**data, 'phone_number': phone_number})
+                batch.delete(doc.reference)
+                async for entry in call_index.where(filter=firestore.FieldFilter('lead_id', '==', doc.id)).stream():
+                    batch.update(entry.reference, {'lead_id': new_id})
+                try:
+                    await batch.commit()
+                except AlreadyExists:
+                    stats['duplicates'] += 1
+                    self.logger.warning("Lead %s duplicates lead %s (phone %s); left in place", doc.id, new_id, phone_number)
+                    continue
+                self._lead_cache.invalidate(doc.id)
+                stats['rekeyed'] += 1
+        
+        self.logger.info("Legacy lead rekey complete: %s", stats)
+        return stats
+
     async def bulk_create_leads(self, leads: List[Lead]) -> List[str]:
-        """Create multiple leads in batch, handling potential duplicates."""
+        """
+        Create multiple leads, skipping phone numbers that already have a lead.
+        Each lead's document ID is derived from its phone number, so create() itself detects duplicates
+        (AlreadyExists) and no existence query is needed before writing.
+        """
         try:
             if not leads:
                 self.logger.info("No leads to bulk create.")
                 return []
 
-            batch = self.db.batch()
             created_lead_ids = []
             updated_lead_ids = [] # To keep track of updated leads 
             skipped_leads_count = 0
-            
-            for lead in leads:
-                # 1. Check if a lead with this phone number already exists
-                existing_lead = await self.get_lead_by_phone_number(lead.phone_number)
+            # Bounds in-flight create RPCs on the shared channel
+            semaphore = asyncio.Semaphore(self.CREATE_CONCURRENCY)
 
-                if existing_lead:
-                    # OPTION 1: Skip 
-                    self.logger.info(f"Skipping lead with phone number {lead.phone_number} (ID: {existing_lead.id}) as it already exists.")
-                    skipped_leads_count += 1
+            async def _create(lead: Lead) -> Optional[str]:
+                lead_dict = {**lead.model_dump(**LEAD_DUMP_KW), **_NEW_LEAD_DEFAULTS}
+                doc_ref = self._leads.document(self.lead_doc_id(lead.phone_number))
+                async with semaphore:
+                    try:
+                        await doc_ref.create(lead_dict)
+                    except AlreadyExists:
+                        # OPTION 1: Skip 
+                        self.logger.info("Skipping lead with phone number %s (ID: %s) as it already exists.", lead.phone_number, doc_ref.id)
+                        return None
                     
                     # OPTION 2: we might choose to update it instead:
                     # update_data = lead.model_dump(exclude={'id', 'created_at'}, exclude_none=True)
                     # update_data['updated_at'] = firestore.SERVER_TIMESTAMP
-                    # batch.update(self.db.collection(self.LEADS_COLLECTION).document(existing_lead.id), update_data)
-                    # updated_lead_ids.append(existing_lead.id)
-                else:
-                    # 2. If it doesn't exist, create a new one
-                    lead_dict = lead.model_dump(exclude_none=True)
-                    lead_dict['created_at'] = firestore.SERVER_TIMESTAMP
-                    lead_dict['updated_at'] = firestore.SERVER_TIMESTAMP
-                    lead_dict['call_status'] = CallStatus.NEW.value
-                    lead_dict['number_of_retries'] = 0
-                    lead_dict['last_call_time'] = None
-                    lead_dict['callback_time'] = None
-                    lead_dict['retry_date'] = None
-                    
-                    doc_ref = self.db.collection(self.LEADS_COLLECTION).document()
-                    batch.set(doc_ref, lead_dict)
-                    created_lead_ids.append(doc_ref.id)
+                    # await doc_ref.update(update_data)
+                    # updated_lead_ids.append(doc_ref.id)
+                return doc_ref.id
+
+            # A number repeated within this call is written once (the repeats count as skipped)
+            seen_phone_numbers = set()
+            unique_leads = []
+            for lead in leads:
+                if lead.phone_number in seen_phone_numbers:
+                    skipped_leads_count += 1
+                    continue
+                seen_phone_numbers.add(lead.phone_number)
+                unique_leads.append(lead)
+            
+            if settings.legacy_lead_dedupe:
+                existing = await self._legacy_phone_numbers([lead.phone_number for lead in unique_leads])
+                if existing:
+                    skipped_leads_count += len(existing)
+                    self.logger.info("Skipping %s leads whose phone numbers already have a (legacy) lead", len(existing))
+                    unique_leads = [lead for lead in unique_leads if lead.phone_number not in existing]
             
-            # Commit the batch operation
-            await asyncio.to_thread(batch.commit)
+            results = await asyncio.gather(*(_create(lead) for lead in unique_leads))
+            for lead_id in results:
+                if lead_id is None:
+                    skipped_leads_count += 1
+                else:
+                    created_lead_ids.append(lead_id)
             
             total_processed = len(created_lead_ids) + len(updated_lead_ids) + skipped_leads_count
-            self.logger.info(f"Bulk lead processing complete: Created {len(created_lead_ids)} new leads, updated {len(updated_lead_ids)} existing leads, skipped {skipped_leads_count} leads. Total processed from batch: {total_processed}")
+            self.logger.info("Bulk lead processing complete: Created %s new leads, updated %s existing leads, skipped %s leads. Total processed from batch: %s", len(created_lead_ids), len(updated_lead_ids), skipped_leads_count, total_processed)
             
             return created_lead_ids # Return IDs of newly created leads
             
         except Exception as e:
-            self.logger.error(f"Error in bulk create leads: {str(e)}")
+            self.logger.error("Error in bulk create leads: %s", e)
             raise
 
+    def lead_doc_id(self, phone_number: str) -> str:
+        """Deterministic document ID for a lead: 64-bit xxhash of its (E.164) phone number"""
+        return xxhash.xxh64(phone_number.encode('utf-8')).hexdigest()
+
 ###############################################################################################3
     async def update_lead(self, lead_id: str, update_data: Dict[str, Any]) -> bool:
-        """Update a lead document (synchronous operation run in thread)"""
+        """Update a lead document"""
+        return await self.apply_lead_transition(lead_id, update_data)
+
+    async def apply_lead_transition(self, lead_id: str, patch: Dict[str, Any]) -> bool:
+        """
+        Write a merged lead patch (e.g. post-call data plus the status change it leads to) in one update RPC.
+        updated_at is added automatically; build status patches with status_patch/retry_patch/callback_patch.
+        """
         try:
-            update_data['updated_at'] = firestore.SERVER_TIMESTAMP
-            
-            # Use asyncio.to_thread to run the blocking Firestore call
-            await asyncio.to_thread(
-                self.db.collection(self.LEADS_COLLECTION).document(lead_id).update,
-                update_data
-            )
-            self.logger.info(f"Updated lead {lead_id} with data: {update_data.keys()}")
+            # Coalesced with other updates arriving at the same time; resolves once its batch commits
+            await self._enqueue_update(lead_id, patch)
+            self.logger.info("Updated lead %s with data: %s", lead_id, patch.keys())
             return True
             
         except Exception as e:
-            self.logger.error(f"Error updating lead {lead_id}: {str(e)}")
+            self.logger.error("Error updating lead %s: %s", lead_id, e)
             raise # Important to raise here for proper error handling upstream
     
-    async def get_lead(self, lead_id: str) -> Optional[Lead]:
-        """Get a lead by ID (synchronous operation run in thread)"""
+    async def _enqueue_update(self, lead_id: str, patch: Dict[str, Any]) -> None:
+        """Queue a lead patch for the coalescing worker and wait for its batch to commit"""
+        if self._closed:
+            raise RuntimeError("FirebaseService is closed")
+        if self._update_worker is None or self._update_worker.done():
+            self._update_queue = asyncio.Queue()
+            self._update_worker = asyncio.create_task(self._run_update_worker())
+        future = asyncio.get_running_loop().create_future()
+        await self._update_queue.put((lead_id, patch, future))
+        await future
+
+    async def _run_update_worker(self) -> None:
+        """
+        Drain queued lead updates into write batches: up to lead_update_batch_max updates,
+        collected for at most lead_update_batch_window_ms after the first one arrives.
+        """
+        loop = asyncio.get_running_loop()
+        window = settings.lead_update_batch_window_ms / 1000
+        stopping = False
+        while not stopping:
+            item = await self._update_queue.get()
+            if item is None:
+                break
+            pending = [item]
+            deadline = loop.time() + window
+            while len(pending) < settings.lead_update_batch_max:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._update_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                pending.append(item)
+            
+            await self._write_pending_updates(pending)
+        
+        # Nothing can be enqueued once close() has started, but never leave a caller waiting forever
+        while not self._update_queue.empty():
+            item = self._update_queue.get_nowait()
+            if item is not None and not item[2].done():
+                item[2].set_exception(RuntimeError("FirebaseService is closed"))
+
+    async def _write_pending_updates(self, pending: List[Tuple[str, Dict[str, Any], asyncio.Future]]) -> None:
+        """
+        Commit a drained set of queued updates and resolve each caller's future.
+        The batch is atomic, so if it fails (e.g. one lead was deleted) each lead is retried on its own
+        and every caller gets the outcome of its own write.
+        """
+        # Several patches for one lead in the same batch are merged in arrival order
+        updates: Dict[str, Dict[str, Any]] = {}
+        futures: Dict[str, List[asyncio.Future]] = {}
+        for lead_id, patch, future in pending:
+            updates.setdefault(lead_id, {}).update(patch)
+            futures.setdefault(lead_id, []).append(future)
+        
+        errors: Dict[str, BaseException] = {}
         try:
-            # Use asyncio.to_thread to run the blocking Firestore call
-            doc = await asyncio.to_thread(self.db.collection(self.LEADS_COLLECTION).document(lead_id).get)
-            if doc.exists:
-                data = doc.to_dict()
-                data['id'] = doc.id
-                return Lead(**data)
-            self.logger.warning(f"Lead with ID {lead_id} not found in {self.LEADS_COLLECTION}.")
-            return None
+            await self.update_leads_bulk(updates)
+        except Exception as e:
+            if len(updates) == 1:
+                errors = dict.fromkeys(updates, e)
+            else:
+                results = await asyncio.gather(
+                    *(self.update_leads_bulk({lead_id: patch}) for lead_id, patch in updates.items()),
+                    return_exceptions=True
+                )
+                errors = {lead_id: result for lead_id, result in zip(updates, results) if isinstance(result, Exception)}
+        
+        for lead_id, lead_futures in futures.items():
+            for future in lead_futures:
+                if future.done():
+                    continue
+                if lead_id in errors:
+                    future.set_exception(errors[lead_id])
+                else:
+                    future.set_result(None)
+
+    async def close(self) -> None:
+        """Flush queued lead updates and stop the coalescing worker"""
+        self._closed = True
+        if self._update_worker is not None and not self._update_worker.done():
+            await self._update_queue.put(None)
+            await self._update_worker
+        self._update_worker = None
+
+    async def record_call(self, lead_id: str, call_id: str, patch: Dict[str, Any]) -> bool:
+        """
+        Apply a lead patch for a newly placed call and index the Retell call ID to the lead,
+        both in one write batch.
+        """
+        try:
+            patch['updated_at'] = firestore.SERVER_TIMESTAMP
+            batch = self.db.batch()
+            batch.update(self._leads.document(lead_id), patch)
+            batch.set(self.db.collection(self.CALL_INDEX_COLLECTION).document(call_id), {
+                'lead_id': lead_id,
+                'created_at': firestore.SERVER_TIMESTAMP
+            })
+            await batch.commit()
+            self._lead_cache.invalidate(lead_id)
+            self.logger.info("Recorded call %s for lead %s", call_id, lead_id)
+            return True
             
         except Exception as e:
-            self.logger.error(f"Error getting lead {lead_id}: {str(e)}")
+            self.logger.error("Error recording call %s for lead %s: %s", call_id, lead_id, e)
             raise
 
-    async def get_callback_leads_for_window(self, window_start: datetime, window_end: datetime) -> List[Lead]:
-        """Get callback leads scheduled for the current time window (synchronous operation run in thread)."""
+    async def get_lead_by_call_id(self, call_id: str) -> Optional[Lead]:
+        """Get the lead a Retell call was placed for, via the call_index collection (None if not indexed)"""
         try:
-            leads_list: List[Lead] = []
-            query = (self.db.collection(self.LEADS_COLLECTION)
-                     .where(filter=firestore.FieldFilter('call_status', '==', CallStatus.CALLBACK.value))
-                     .where(filter=firestore.FieldFilter('callback_time', '>=', window_start))
-                     .where(filter=firestore.FieldFilter('callback_time', '<', window_end))
-                     .order_by('callback_time')
-                     .limit(settings.firebase_query_limit))
+            doc = await self.db.collection(self.CALL_INDEX_COLLECTION).document(call_id).get()
+            if not doc.exists:
+                return None
+            return await self.get_lead(doc.get('lead_id'))
             
-            # --- IMPORTANT: Use asyncio.to_thread for the synchronous .stream() call ---
-            docs_stream = await asyncio.to_thread(query.stream)
+        except Exception as e:
+            self.logger.error("Error getting lead for call %s: %s", call_id, e)
+            raise
+
+    async def update_leads_bulk(self, updates: Dict[str, Dict[str, Any]]) -> bool:
+        """Apply several lead patches ({lead_id: patch}) with write batches instead of one RPC per lead"""
+        try:
+            lead_ids = list(updates)
+            for i in range(0, len(lead_ids), self.BATCH_WRITE_LIMIT):
+                batch = self.db.batch()
+                for lead_id in lead_ids[i:i + self.BATCH_WRITE_LIMIT]:
+                    patch = updates[lead_id]
+                    patch['updated_at'] = firestore.SERVER_TIMESTAMP
+                    batch.update(self._leads.document(lead_id), patch)
+                await batch.commit()
             
-            for doc in docs_stream: 
-                try:
-                    data = doc.to_dict()
-                    data['id'] = doc.id
-                    leads_list.append(Lead(**data))
-                except Exception as e:
-                    self.logger.warning(f"Skipping malformed callback lead document {doc.id}: {e}")
+            for lead_id in lead_ids:
+                self._lead_cache.invalidate(lead_id)
+            self.logger.info("Bulk updated %s leads", len(lead_ids))
+            return True
+            
+        except Exception as e:
+            self.logger.error("Error bulk updating %s leads: %s", len(updates), e)
+            raise
 
-            self.logger.debug(f"Retrieved {len(leads_list)} callback leads for window {window_start} - {window_end}")
+    async def get_lead(self, lead_id: str) -> Optional[Lead]:
+        """Get a lead by ID (served from a short TTL cache; updates through this service invalidate it)"""
+        try:
+            return await self._lead_cache.get(lead_id, lambda: self._fetch_lead(lead_id))
+            
+        except Exception as e:
+            self.logger.error("Error getting lead %s: %s", lead_id, e)
+            raise
+
+    async def _fetch_lead(self, lead_id: str) -> Optional[Lead]:
+        """Read a lead document from Firestore"""
+        doc = await self._leads.document(lead_id).get()
+        if doc.exists:
+            return Lead.from_firestore(doc.id, doc.to_dict())
+        self.logger.warning("Lead with ID %s not found in %s.", lead_id, self.LEADS_COLLECTION)
+        return None
+
+    async def get_callback_leads_for_window(self, window_start: datetime, window_end: datetime) -> List[Lead]:
+        """Get all callback leads scheduled for the current time window."""
+        try:
+            leads_list = [lead async for lead in self.iter_callback_leads_for_window(window_start, window_end)]
+            self.logger.debug("Retrieved %s callback leads for window %s - %s", len(leads_list), window_start, window_end)
             return leads_list
             
         except Exception as e:
-            self.logger.error(f"Error getting current window callbacks: {str(e)}")
+            self.logger.error("Error getting current window callbacks: %s", e)
             raise
 
+    async def iter_callback_leads_for_window(self, window_start: datetime, window_end: datetime) -> AsyncIterator[Lead]:
+        """
+        Yield every callback lead in [window_start, window_end), paging with a start_after cursor
+        (QUERY_PAGE_SIZE documents per query) so large windows are drained instead of truncated.
+        Served by the (call_status, callback_time) composite index in firestore.indexes.json.
+        """
+        base_query = (self._leads
+                      .where(filter=self._filter_callback)
+                      .where(filter=firestore.FieldFilter('callback_time', '>=', window_start))
+                      .where(filter=firestore.FieldFilter('callback_time', '<', window_end))
+                      .order_by('callback_time')
+                      .limit(self.QUERY_PAGE_SIZE))
+        
+        last_doc = None
+        while True:
+            query = base_query.start_after(last_doc) if last_doc is not None else base_query
+            docs_count = 0
+            async for doc in query.stream(): 
+                last_doc = doc
+                docs_count += 1
+                try:
+                    lead = Lead.from_firestore(doc.id, doc.to_dict())
+                except Exception as e:
+                    self.logger.warning("Skipping malformed callback lead document %s: %s", doc.id, e)
+                    continue
+                yield lead
+            if docs_count < self.QUERY_PAGE_SIZE:
+                break
+
     async def get_missed_callback_leads(self, current_window_start: datetime) -> List[Lead]:
-        """Get callback leads that were scheduled before current window but not called yet (synchronous operation run in thread)."""
+        """Get callback leads that were scheduled before current window but not called yet."""
         try:
             leads_list: List[Lead] = []
-            query = (self.db.collection(self.LEADS_COLLECTION)
-                     .where(filter=firestore.FieldFilter('call_status', '==', CallStatus.CALLBACK.value))
+            query = (self._leads
+                     .where(filter=self._filter_callback)
                      .where(filter=firestore.FieldFilter('callback_time', '<', current_window_start))
                      .order_by('callback_time')
                      .limit(settings.firebase_query_limit))
             
-            # --- IMPORTANT: Use asyncio.to_thread for the synchronous .stream() call ---
-            docs_stream = await asyncio.to_thread(query.stream)
-            
-            for doc in docs_stream: 
+            async for doc in query.stream(): 
                 try:
-                    data = doc.to_dict()
-                    data['id'] = doc.id
-                    leads_list.append(Lead(**data))
+                    leads_list.append(Lead.from_firestore(doc.id, doc.to_dict()))
                 except Exception as e:
-                    self.logger.warning(f"Skipping malformed missed callback lead document {doc.id}: {e}")
+                    self.logger.warning("Skipping malformed missed callback lead document %s: %s", doc.id, e)
 
-            self.logger.debug(f"Retrieved {len(leads_list)} missed callback leads before {current_window_start}")
+            self.logger.debug("Retrieved %s missed callback leads before %s", len(leads_list), current_window_start)
             return leads_list
             
         except Exception as e:
-            self.logger.error(f"Error getting missed callbacks: {str(e)}")
+            self.logger.error("Error getting missed callbacks: %s", e)
             raise
 
     async def get_retry_leads_for_date(self, target_date: date) -> List[Lead]:
-        """Get retry leads scheduled for a specific date (synchronous operation run in thread)."""
+        """Get retry leads scheduled for a specific date."""
         try:
             leads_list: List[Lead] = []
             start_of_day = datetime.combine(target_date, datetime.min.time(), tzinfo=settings.app_timezone_obj)
-            end_of_day = datetime.combine(target_date, datetime.max.time(), tzinfo=settings.app_timezone_obj)
+            # Half-open [start_of_day, start_of_next_day), matching the callback window queries
+            end_of_day = start_of_day + timedelta(days=1)
 
-            query = (self.db.collection(self.LEADS_COLLECTION)
-                     .where(filter=firestore.FieldFilter('call_status', '==', CallStatus.RETRY.value))
+            query = (self._leads
+                     .where(filter=self._filter_retry)
                      .where(filter=firestore.FieldFilter('retry_date', '>=', start_of_day))
-                     .where(filter=firestore.FieldFilter('retry_date', '<=', end_of_day))
+                     .where(filter=firestore.FieldFilter('retry_date', '<', end_of_day))
                      .order_by('retry_date')
                      .limit(settings.firebase_query_limit))
             
-            # --- IMPORTANT: Use asyncio.to_thread for the synchronous .stream() call ---
-            docs_stream = await asyncio.to_thread(query.stream)
-            
-            for doc in docs_stream: 
+            async for doc in query.stream(): 
                 try:
-                    data = doc.to_dict()
-                    data['id'] = doc.id
-                    leads_list.append(Lead(**data))
+                    leads_list.append(Lead.from_firestore(doc.id, doc.to_dict()))
                 except Exception as e:
-                    self.logger.warning(f"Skipping malformed retry lead document {doc.id}: {e}")
+                    self.logger.warning("Skipping malformed retry lead document %s: %s", doc.id, e)
 
-            self.logger.debug(f"Retrieved {len(leads_list)} retry leads for date {target_date.strftime('%Y-%m-%d')}.")
+            self.logger.debug("Retrieved %s retry leads for date %s.", len(leads_list), target_date)
             return leads_list
             
         except Exception as e:
-            self.logger.error(f"Error getting retry leads for date {target_date.strftime('%Y-%m-%d')}: {str(e)}")
+            self.logger.error("Error getting retry leads for date %s: %s", target_date, e)
             raise
 
-    async def get_new_leads(self) -> List[Lead]:
-        """Get new leads that haven't been called yet (synchronous operation run in thread)."""
+    async def get_new_leads(self, cursor: Optional[PageCursor] = None) -> List[Lead]:
+        """
+        Get new leads that haven't been called yet.
+        Without a cursor this is the first page. With one, each call returns the page after the last one read
+        through that cursor, so a calling window can keep draining without re-reading the prefix.
+        """
         try:
-            leads_list: List[Lead] = []
-            query = (self.db.collection(self.LEADS_COLLECTION)
-                     .where(filter=firestore.FieldFilter('call_status', '==', CallStatus.NEW.value))
-                     .order_by('created_at')
-                     .limit(settings.firebase_query_limit))
+            leads_list = [lead async for lead in self.iter_new_leads(cursor)]
+            self.logger.debug("Retrieved %s new leads.", len(leads_list))
+            return leads_list
+            
+        except Exception as e:
+            self.logger.error("Error getting new leads: %s", e)
+            raise
+
+    async def iter_new_leads(self, cursor: Optional[PageCursor] = None) -> AsyncIterator[Lead]:
+        """
+        Streaming form of get_new_leads: yields each lead of the page as its document arrives,
+        so callers can start dialing before the whole page is read. Same cursor semantics.
+        """
+        query = (self._leads
+                 .where(filter=self._filter_new)
+                 .order_by('created_at'))
+        if cursor is not None:
+            if cursor.exhausted:
+                return # Previous page was the last one
+            if cursor.last_doc is not None:
+                query = query.start_after(cursor.last_doc)
+            # Stays set unless this page is read in full (a consumer that stops early ends the paging)
+            cursor.exhausted = True
+        query = query.limit(settings.firebase_query_limit)
+        
+        last_doc = None
+        docs_count = 0
+        async for doc in query.stream(): 
+            last_doc = doc
+            docs_count += 1
+            try:
+                lead = Lead.from_firestore(doc.id, doc.to_dict())
+            except Exception as e:
+                self.logger.warning("Skipping malformed new lead document %s: %s", doc.id, e)
+                continue
+            yield lead
+
+        # Only keep paging while full pages come back
+        if cursor is not None and docs_count >= settings.firebase_query_limit:
+            cursor.last_doc = last_doc
+            cursor.exhausted = False
+
+    async def count_by_status(self, status: Optional[CallStatus] = None) -> int:
+        """
+        Count leads with the given call_status (or all leads when status is None)
+        using a server-side aggregation query, so no documents are streamed.
+        """
+        try:
+            query = self._leads
+            if status is not None:
+                query = query.where(filter=firestore.FieldFilter('call_status', '==', status.value))
             
-            # --- IMPORTANT: Use asyncio.to_thread for the synchronous .stream() call ---
-            docs_stream = await asyncio.to_thread(query.stream)
+            results = await query.count().get()
+            return int(results[0][0].value)
             
-            for doc in docs_stream: 
-                try:
-                    data = doc.to_dict()
-                    data['id'] = doc.id
-                    leads_list.append(Lead(**data))
-                except Exception as e:
-                    self.logger.warning(f"Skipping malformed new lead document {doc.id}: {e}")
+        except Exception as e:
+            self.logger.error("Error counting leads with status %s: %s", status.value if status else 'any', e)
+            raise
 
-            self.logger.debug(f"Retrieved {len(leads_list)} new leads.")
-            return leads_list
+    async def any_lead_with_status(self, statuses: Iterable[CallStatus]) -> bool:
+        """True if at least one lead has one of the given call_status values (one key-only document read at most)"""
+        try:
+            query = (self._leads
+                     .where(filter=firestore.FieldFilter('call_status', 'in', [status.value for status in statuses]))
+                     .select([])
+                     .limit(1))
+            async for _ in query.stream():
+                return True
+            return False
             
         except Exception as e:
-            self.logger.error(f"Error getting new leads: {str(e)}")
+            self.logger.error("Error checking for leads with statuses %s: %s", statuses, e)
             raise
 
+    def status_patch(self, new_status: CallStatus) -> Dict[str, Any]:
+        """Lead fields written for a plain call_status change"""
+        patch = {'call_status': new_status.value}
+        if new_status == CallStatus.CALLING:
+            patch['last_call_time'] = firestore.SERVER_TIMESTAMP
+        return patch
+
+    def retry_patch(self, retry_count: int, retry_date: date) -> Dict[str, Any]:
+        """Lead fields written when a lead is moved to RETRY"""
+        return {
+            'call_status': CallStatus.RETRY.value,
+            'number_of_retries': retry_count,
+            'retry_date': datetime.combine(retry_date, datetime.min.time(), tzinfo=settings.app_timezone_obj),
+            'last_call_time': firestore.SERVER_TIMESTAMP
+        }
+
+    def callback_patch(self, callback_time: datetime) -> Dict[str, Any]:
+        """Lead fields written when a lead is moved to CALLBACK"""
+        return {
+            'call_status': CallStatus.CALLBACK.value,
+            'callback_time': callback_time
+        }
+
     async def update_lead_status(self, lead_id: str, new_status: CallStatus) -> bool:
-        """Update the call_status of a lead (synchronous operation run in thread)."""
+        """Update the call_status of a lead."""
         try:
-            update_data = {
-                'call_status': new_status.value,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            }
-            if new_status == CallStatus.CALLING:
-                update_data['last_call_time'] = firestore.SERVER_TIMESTAMP
-            
-            # Use asyncio.to_thread to run the blocking Firestore call
-            await asyncio.to_thread(
-                self.db.collection(self.LEADS_COLLECTION).document(lead_id).update,
-                update_data
-            )
-            self.logger.info(f"Updated lead {lead_id} status to {new_status.value}")
+            await self.apply_lead_transition(lead_id, self.status_patch(new_status))
+            self.logger.info("Updated lead %s status to %s", lead_id, new_status.value)
             return True
         except Exception as e:
-            self.logger.error(f"Error updating status for lead {lead_id}: {str(e)}")
+            self.logger.error("Error updating status for lead %s: %s", lead_id, e)
             return False
 
     async def move_lead_to_retry(self, lead_id: str, retry_count: int, retry_date: date) -> bool:
-        """Updates a lead's status to RETRY and sets retry details (synchronous operation run in thread)."""
+        """Updates a lead's status to RETRY and sets retry details."""
         try:
-            update_data = {
-                'call_status': CallStatus.RETRY.value,
-                'number_of_retries': retry_count,
-                'retry_date': datetime.combine(retry_date, datetime.min.time(), tzinfo=settings.app_timezone_obj),
-                'updated_at': firestore.SERVER_TIMESTAMP,
-                'last_call_time': firestore.SERVER_TIMESTAMP
-            }
-            # This calls update_lead, which is now also using asyncio.to_thread
-            await self.update_lead(lead_id, update_data) 
-            self.logger.info(f"Moved lead {lead_id} to retry (attempt {retry_count}) for {retry_date.strftime('%Y-%m-%d')}")
+            await self.apply_lead_transition(lead_id, self.retry_patch(retry_count, retry_date))
+            self.logger.info("Moved lead %s to retry (attempt %s) for %s", lead_id, retry_count, retry_date)
             return True
         except Exception as e:
-            self.logger.error(f"Error moving lead {lead_id} to retry: {str(e)}")
+            self.logger.error("Error moving lead %s to retry: %s", lead_id, e)
             return False
     
+    async def increment_retry_and_schedule(self, lead_id: str, max_retries: int, retry_date: date,
+                                           extra_patch: Optional[Dict[str, Any]] = None) -> Tuple[bool, int]:
+        """
+        Move a lead to RETRY (incrementing number_of_retries) or to FAILED once max_retries is reached, deciding
+        on the stored retry count inside a Firestore transaction so concurrent webhooks can't double-increment.
+        extra_patch (e.g. post-call data) is written in the same update. Returns (scheduled_for_retry, retry_count).
+        """
+        doc_ref = self._leads.document(lead_id)
+
+        @async_transactional
+        async def _increment(transaction) -> Tuple[bool, int]:
+            snapshot = await doc_ref.get(field_paths=['number_of_retries'], transaction=transaction)
+            # Legacy and imported leads may lack the field; DocumentSnapshot.get() would raise KeyError
+            retries = (snapshot.to_dict() or {}).get('number_of_retries') or 0
+            if retries < max_retries:
+                patch, scheduled, retries = self.retry_patch(retries + 1, retry_date), True, retries + 1
+            else:
+                patch, scheduled = self.status_patch(CallStatus.FAILED), False
+            transaction.update(doc_ref, {**(extra_patch or {}), **patch, 'updated_at': firestore.SERVER_TIMESTAMP})
+            return scheduled, retries
+
+        try:
+            result = await _increment(self.db.transaction())
+            self._lead_cache.invalidate(lead_id)
+            return result
+        except Exception as e:
+            self.logger.error("Error scheduling retry for lead %s: %s", lead_id, e)
+            raise
+
     async def move_lead_to_callback(self, lead_id: str, callback_time: datetime) -> bool:
-        """Updates a lead's status to CALLBACK and sets callback time (synchronous operation run in thread)."""
+        """Updates a lead's status to CALLBACK and sets callback time."""
         try:
-            update_data = {
-                'call_status': CallStatus.CALLBACK.value,
-                'callback_time': callback_time,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            }
-            # This calls update_lead, which is now also using asyncio.to_thread
-            await self.update_lead(lead_id, update_data)
-            self.logger.info(f"Moved lead {lead_id} to callback for {callback_time}")
+            await self.apply_lead_transition(lead_id, self.callback_patch(callback_time))
+            self.logger.info("Moved lead %s to callback for %s", lead_id, callback_time)
             return True
         except Exception as e:
-            self.logger.error(f"Error moving lead {lead_id} to callback: {str(e)}")
+            self.logger.error("Error moving lead %s to callback: %s", lead_id, e)
             return False
 
     async def remove_lead_entry_from_queue_collection(self, collection_name: str, lead_id_to_find: str) -> None:
         """
         Removes a document from a specific queue collection that refers to a given main lead_id.
-        (Synchronous operation run in thread).
         """
-        self.logger.debug(f"Attempting to remove lead_id {lead_id_to_find} from {collection_name} queue.")
+        self.logger.debug("Attempting to remove lead_id %s from %s queue.", lead_id_to_find, collection_name)
         try:
-            query = self.db.collection(collection_name).where(filter=firestore.FieldFilter('lead_id', '==', lead_id_to_find))
+            # Only doc.reference is used, so fetch no fields
+            query = (self.db.collection(collection_name)
+                     .where(filter=firestore.FieldFilter('lead_id', '==', lead_id_to_find))
+                     .select([]))
             
-            # --- IMPORTANT: Use asyncio.to_thread for the synchronous .stream() call ---
-            docs_stream = await asyncio.to_thread(query.stream)
+            refs = [doc.reference async for doc in query.stream()]
             
-            for doc in docs_stream: 
-                # doc.reference.delete() is also synchronous, needs to be awaited via to_thread
-                await asyncio.to_thread(doc.reference.delete)
-                self.logger.debug(f"Removed queue entry {doc.id} for lead {lead_id_to_find} from {collection_name}.")
+            # Delete in write batches instead of one RPC per entry
+            for i in range(0, len(refs), self.BATCH_WRITE_LIMIT):
+                batch = self.db.batch()
+                for ref in refs[i:i + self.BATCH_WRITE_LIMIT]:
+                    batch.delete(ref)
+                await batch.commit()
+            if refs:
+                self.logger.debug("Removed %s queue entries for lead %s from %s.", len(refs), lead_id_to_find, collection_name)
         except Exception as e:
-            self.logger.warning(f"Failed to remove lead {lead_id_to_find} from {collection_name} queue: {e}")
\ No newline at end of file
+            self.logger.warning("Failed to remove lead %s from %s queue: %s", lead_id_to_find, collection_name, e)
\ No newline at end of file
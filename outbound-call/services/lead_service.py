@@ -1,94 +1,188 @@
 # services/lead_service.py
 import logging
 import asyncio
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator, AsyncIterable, Iterable, Tuple, Union
+from functools import lru_cache
+import re
 from datetime import datetime, timedelta, date
-import pytz # Import pytz explicitly for clarity with timezone usage
 
-from services.firebase_service import FirebaseService
+from services.firebase_service import FirebaseService, PageCursor
 from services.retell_service import RetellService # Ensure this uses httpx now
-from models.lead_models import Lead, CallStatus, DisconnectionReason, RetellCreateCallRequest
+from models.lead_models import Lead, CallStatus, DisconnectionReason, RetellCreateCallRequest, CallWebhookEvent
 from config.settings import settings
+from utils.rate_limiter import TokenBucket
+from utils.ttl_cache import SingleFlightTTL
 from firebase_admin import firestore
 
+# Lead statuses the dialer may call
+_CALLABLE_STATUSES = frozenset({CallStatus.NEW, CallStatus.CALLBACK, CallStatus.RETRY})
+
+# CSV columns mapped onto Lead fields; every other column goes into custom_data
+_LEAD_COLUMNS = frozenset({'phone_number', 'name', 'email', 'company'})
+
+# Accepted callback time formats: 'YYYY-MM-DD[ T]HH:MM[:SS[.ffffff]]', or 'HH:MM' meaning today at that time.
+# Like strptime's %m/%d/%H/%M/%S, every field but the year may have one or two digits ('2024-1-5 9:30', '09:5')
+_CALLBACK_DATETIME_RE = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})[ T](\d{1,2}):(\d{1,2})(?::(\d{1,2})(?:\.(\d{1,6}))?)?$')
+_CALLBACK_TIME_RE = re.compile(r'^(\d{1,2}):(\d{1,2})$')
+_RELATIVE_CALLBACK_TERMS = frozenset({'tomorrow', 'next day'})
+
+@lru_cache(maxsize=1024)
+def _parse_callback_time_naive(callback_time_str: str) -> Optional[Tuple[datetime, bool]]:
+    """
+    Parse a callback time string into (naive datetime, time_only), or None if no format matches.
+    Cached per string; the time zone and "today" are applied by the caller since they depend on now.
+    """
+    try:
+        match = _CALLBACK_DATETIME_RE.match(callback_time_str)
+        if match:
+            year, month, day, hour, minute, second, fraction = match.groups()
+            return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                            int(second or 0), int((fraction or '0').ljust(6, '0'))), False
+        match = _CALLBACK_TIME_RE.match(callback_time_str)
+        if match:
+            return datetime(1900, 1, 1, int(match.group(1)), int(match.group(2))), True
+    except ValueError:
+        pass # Matched the shape but not a real date/time (e.g. month 13)
+    return None
+
+def _set_priority(lead: Lead, priority: int, reason: str) -> None:
+    """Tag a lead with its calling priority (server-set values, so pydantic's __setattr__ is skipped)"""
+    object.__setattr__(lead, 'priority', priority)
+    object.__setattr__(lead, 'priority_reason', reason)
+
 class LeadService:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
-        self.firebase_service = FirebaseService()
-        self.retell_service = RetellService()
+        self.firebase_service = FirebaseService.get_instance()
+        self.retell_service = RetellService.get_instance()
+        # Caps in-flight Retell create-call requests across every batch run by this service
+        # (scheduled and manually triggered batches can overlap; each batch's worker pool only bounds itself)
+        self._call_semaphore = asyncio.Semaphore(settings.max_concurrent_calls)
+        # Paces call initiations to Retell's rate budget (shared by overlapping batches too)
+        self._dispatch_bucket = TokenBucket(settings.retell_burst, settings.retell_rps)
+        # call_ids of recently applied call_analyzed webhooks (dedupes Retell retries). Best-effort only:
+        # the cache is per worker process (settings.workers of them), so a retry landing on another worker is applied again
+        self._processed_calls = SingleFlightTTL(settings.webhook_dedupe_ttl_seconds, maxsize=settings.webhook_dedupe_max_entries)
     
-    async def process_csv_leads(self, csv_data: List[Dict[str, Any]]) -> List[str]:
-        """Process and create leads from CSV data"""
+    async def process_csv_leads(self, csv_chunks: AsyncIterator[List[Dict[str, Any]]],
+                                lead_ids: Optional[List[str]] = None,
+                                skipped: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+        """
+        Process and create leads from streamed CSV record chunks, writing each chunk as it arrives.
+        Created IDs are appended to lead_ids (if given) as each chunk commits, so a caller still has them
+        when a later chunk fails; in-file duplicate rows are appended to skipped as {'reason', 'record'}.
+        """
         try:
-            leads = []
-            for row in csv_data:
-                lead = Lead(
-                    phone_number=row.get('phone_number', ''),
-                    name=row.get('name', ''),
-                    email=row.get('email', ''),
-                    company=row.get('company', ''),
-                    # Ensure custom_data is always a dict, even if missing in CSV
-                    custom_data={k: v for k, v in row.items() 
-                                 if k not in ['phone_number', 'name', 'email', 'company']}
-                )
-                leads.append(lead)
+            lead_ids = [] if lead_ids is None else lead_ids
+            seen_phone_numbers = set() # Drops in-file duplicates across chunks before they reach Firestore
+            async for rows in csv_chunks:
+                unique_rows = []
+                for row in rows:
+                    phone_number = row.get('phone_number', '')
+                    if phone_number in seen_phone_numbers:
+                        self.logger.debug("Skipping duplicate row for phone number %s in upload", phone_number)
+                        if skipped is not None:
+                            skipped.append({'reason': 'duplicate_in_file', 'record': row})
+                        continue
+                    seen_phone_numbers.add(phone_number)
+                    unique_rows.append(row)
+                
+                # Building a whole chunk of models is CPU-bound; keep it off the event loop
+                leads = await asyncio.to_thread(self._build_leads_from_rows, unique_rows)
+                
+                # bulk_create_leads issues one concurrent create() per lead under its phone-derived ID,
+                # so numbers that already have a lead are skipped via AlreadyExists rather than a lookup
+                lead_ids.extend(await self.firebase_service.bulk_create_leads(leads))
             
-            # The bulk_create_leads method in FirebaseService should now handle deduplication.
-            lead_ids = await self.firebase_service.bulk_create_leads(leads)
-            self.logger.info(f"Successfully processed {len(lead_ids)} leads from CSV")
+            self.logger.info("Successfully processed %d leads from CSV", len(lead_ids))
             return lead_ids
             
         except Exception as e:
-            self.logger.error(f"Error processing CSV leads: {str(e)}")
+            self.logger.error("Error processing CSV leads: %s", e)
             raise
     
-    async def process_call_webhook(self, webhook_data: Dict[str, Any]) -> bool:
+    def _build_leads_from_rows(self, rows: List[Dict[str, Any]]) -> List[Lead]:
+        """
+        Build Lead models from CSV rows (blocking; run via asyncio.to_thread).
+        Rows come from the CSV parser as strings with an already-normalized phone number, so
+        model_construct skips per-field validation; webhook and API input is still validated.
+        """
+        leads = []
+        for row in rows:
+            lead = Lead.model_construct(
+                phone_number=row.get('phone_number', ''),
+                name=row.get('name', ''),
+                email=row.get('email', ''),
+                company=row.get('company', ''),
+                # Ensure custom_data is always a dict, even if missing in CSV
+                custom_data={k: v for k, v in row.items() 
+                             if k not in _LEAD_COLUMNS}
+            )
+            leads.append(lead)
+        return leads
+    
+    async def process_call_webhook(self, event: CallWebhookEvent) -> bool:
         """Process incoming webhook from Retell after call completion"""
         try:
-            event_type = webhook_data.get('event_type')
-            if event_type != 'call_analyzed':
-                self.logger.info(f"Ignoring webhook event type: {event_type}")
+            if event.event_type != 'call_analyzed':
+                self.logger.info("Ignoring webhook event type: %s", event.event_type)
                 return True
             
-            call_id = webhook_data.get('call_id')
-            phone_number = webhook_data.get('to_number') 
-            disconnection_reason = webhook_data.get('disconnection_reason')
+            # Retell delivers at-least-once: a retried call_id shares the first delivery's processing/result.
+            # Only successes are cached (the cache skips None), so e.g. a lead not found yet is retried on redelivery
+            async def _process() -> Optional[bool]:
+                return await self._process_call_analyzed(event) or None
+            return bool(await self._processed_calls.get(event.call_id, _process))
+            
+        except Exception as e:
+            self.logger.error("Error processing call webhook: %s", e)
+            raise
+
+    async def _process_call_analyzed(self, event: CallWebhookEvent) -> bool:
+        """Apply a call_analyzed webhook to its lead (called once per call_id via _processed_calls)"""
+        try:
+            call_id = event.call_id
+            phone_number = event.to_number
+            disconnection_reason = event.disconnection_reason
             
-            # Find the lead by phone number
-            lead = await self._find_lead_by_phone(phone_number)
+            # Find the lead by the call ID we indexed when placing the call; fall back to the phone number
+            lead = await self.firebase_service.get_lead_by_call_id(call_id)
+            if not lead:
+                lead = await self._find_lead_by_phone(phone_number)
             if not lead:
-                self.logger.warning(f"No lead found for phone number: {phone_number} from call_id: {call_id}")
+                self.logger.warning("No lead found for phone number: %s from call_id: %s", phone_number, call_id)
                 return False
             
             # Update call completion data on the lead
             post_call_data = {
                 'call_id': call_id,
                 'disconnection_reason': disconnection_reason,
-                'recording_url': webhook_data.get('recording_url'),
-                'public_log_url': webhook_data.get('public_log_url'),
-                'start_timestamp': webhook_data.get('start_timestamp'),
-                'end_timestamp': webhook_data.get('end_timestamp'),
-                'llm_dynamic_variables': webhook_data.get('llm_dynamic_variables', {}) 
+                'recording_url': event.recording_url,
+                'public_log_url': event.public_log_url,
+                'start_timestamp': event.start_timestamp,
+                'end_timestamp': event.end_timestamp,
+                'llm_dynamic_variables': event.llm_dynamic_variables or {}
             }
             
-            # Update last_call_time and post_call_data on the main lead
-            await self.firebase_service.update_lead(lead.id, {
+            # last_call_time and post_call_data are written together with the outcome's status change
+            call_patch = {
                 'post_call_data': post_call_data,
                 'last_call_time': datetime.now(settings.app_timezone_obj) # Use timezone-aware datetime
-            })
+            }
             
             # Determine next action based on disconnection reason and post-call data
-            await self._handle_call_outcome(lead, disconnection_reason, post_call_data)
+            await self._handle_call_outcome(lead, disconnection_reason, post_call_data, call_patch)
             
-            self.logger.info(f"Successfully processed webhook for lead {lead.id}")
+            self.logger.info("Successfully processed webhook for lead %s", lead.id)
             return True
             
         except Exception as e:
-            self.logger.error(f"Error processing call webhook: {str(e)}")
+            self.logger.error("Error processing call webhook: %s", e)
             raise
 
     # --- LEAD PRIORITIZATION AND RETRIEVAL ---
-    async def get_prioritized_leads_for_window(self, window_start: datetime, window_end: datetime) -> List[Lead]:
+    async def get_prioritized_leads_for_window(self, window_start: datetime, window_end: datetime,
+                                               new_leads_cursor: Optional[PageCursor] = None) -> List[Lead]:
         """
         Get leads in priority order based on your document requirements:
         1. Callback requests for current window
@@ -96,66 +190,76 @@ class LeadService:
         3. Retry calls for current day
         4. New leads
         
-        Returns a list of Lead objects.
+        Returns a list of Lead objects. New leads are the first page read through new_leads_cursor (if given),
+        so the caller can continue from there.
         """
         try:
             prioritized_leads: List[Lead] = []
             current_date = datetime.now(settings.app_timezone_obj).date() # Use timezone-aware date
             
-            # Priority 1: Callback requests for current window
-            current_window_callbacks = await self.firebase_service.get_callback_leads_for_window(window_start, window_end)
-            for lead in current_window_callbacks:
-                lead.priority = 1 
-                lead.priority_reason = 'current_window_callback'
-            prioritized_leads.extend(current_window_callbacks)
-            
-            # Priority 2: Missed callback requests from previous windows
-            missed_callbacks = await self.firebase_service.get_missed_callback_leads(window_start)
-            for lead in missed_callbacks:
-                lead.priority = 2
-                lead.priority_reason = 'missed_callback'
-            prioritized_leads.extend(missed_callbacks)
-            
-            # Priority 3: Retry calls for current day
-            today_retries = await self.firebase_service.get_retry_leads_for_date(current_date)
-            for lead in today_retries:
-                lead.priority = 3
-                lead.priority_reason = 'retry_today'
-            prioritized_leads.extend(today_retries)
-            
-            # Priority 4: New leads
-            new_leads = await self.firebase_service.get_new_leads()
-            for lead in new_leads:
-                lead.priority = 4
-                lead.priority_reason = 'new_lead'
-            prioritized_leads.extend(new_leads)
-            
-            self.logger.info(f"Prioritized leads for window: {len(prioritized_leads)} total")
-            self.logger.info(f"Current window callbacks: {len(current_window_callbacks)}")
-            self.logger.info(f"Missed callbacks: {len(missed_callbacks)}")
-            self.logger.info(f"Today retries: {len(today_retries)}")
-            self.logger.info(f"New leads: {len(new_leads)}")
+            # The four queries are independent, so dispatch them concurrently
+            current_window_callbacks, missed_callbacks, today_retries, new_leads = await asyncio.gather(
+                self.firebase_service.get_callback_leads_for_window(window_start, window_end),
+                self.firebase_service.get_missed_callback_leads(window_start),
+                self.firebase_service.get_retry_leads_for_date(current_date),
+                self.firebase_service.get_new_leads(new_leads_cursor)
+            )
+            
+            # 1. Callback requests for current window, 2. missed callbacks from previous windows,
+            # 3. retry calls for current day, 4. new leads -- tagged and appended in one pass
+            for leads, priority, reason in ((current_window_callbacks, 1, 'current_window_callback'),
+                                            (missed_callbacks, 2, 'missed_callback'),
+                                            (today_retries, 3, 'retry_today'),
+                                            (new_leads, 4, 'new_lead')):
+                for lead in leads:
+                    _set_priority(lead, priority, reason)
+                prioritized_leads.extend(leads)
+            
+            # One record per window; counts are also attached as extra fields for structured handlers
+            counts = {
+                'total': len(prioritized_leads),
+                'current_window_callbacks': len(current_window_callbacks),
+                'missed_callbacks': len(missed_callbacks),
+                'today_retries': len(today_retries),
+                'new_leads': len(new_leads),
+            }
+            self.logger.info(
+                "Prioritized leads for window %s: %d total (current window callbacks %d, missed callbacks %d, "
+                "today retries %d, new leads %d)", window_start.isoformat(), *counts.values(),
+                extra={**counts, 'window_start': window_start.isoformat()}
+            )
             
             return prioritized_leads
             
         except Exception as e:
-            self.logger.error(f"Error getting prioritized leads: {str(e)}")
+            self.logger.error("Error getting prioritized leads: %s", e)
             raise
 
+    async def has_pending_leads(self) -> bool:
+        """
+        Cheap probe for whether a calling batch could find anything to dial (any NEW, CALLBACK or RETRY lead).
+        May be True when the only pending leads are due later; never False when a batch would have work.
+        """
+        return await self.firebase_service.any_lead_with_status(_CALLABLE_STATUSES)
+
     # --- CALL EXECUTION ---
-    async def execute_calling_batch(self) -> Dict[str, Any]:
-        """Execute calling batch, respecting business hours and concurrency."""
+    async def execute_calling_batch(self, now_local: Optional[datetime] = None) -> Dict[str, Any]:
+        """
+        Execute calling batch, respecting business hours and concurrency.
+        now_local anchors the calling window: the scheduler passes the tick's scheduled time, manual runs use now.
+        """
         try:
             # Get current time in the application's configured timezone
-            now_local = datetime.now(pytz.utc).astimezone(settings.app_timezone_obj)
+            if now_local is None:
+                now_local = datetime.now(settings.app_timezone_obj)
 
-            self.logger.info(f"Current local time: {now_local.strftime('%Y-%m-%d %H:%M:%S %Z%z')}")
+            self.logger.info("Current local time: %s", now_local.strftime('%Y-%m-%d %H:%M:%S %Z%z'))
             
             # Check if it's within calling hours
             if not self._is_calling_hours(now_local):
                 start_time_str = datetime(1,1,1,settings.calling_start_hour,0,0).strftime('%H:%M')
                 end_time_str = datetime(1,1,1,settings.calling_end_hour,settings.calling_end_minute,0).strftime('%H:%M')
-                self.logger.info(f"Outside calling hours ({start_time_str} - {end_time_str} {settings.app_timezone}). Skipping calling batch.")
+                self.logger.info("Outside calling hours (%s - %s %s). Skipping calling batch.", start_time_str, end_time_str, settings.app_timezone)
                 return {'status': 'skipped', 'reason': 'outside_calling_hours'}
             
             self.logger.info("Within calling hours. Proceeding with lead processing...")
@@ -163,10 +267,16 @@ class LeadService:
             # Calculate current X-minute window (your _get_current_window method already does this)
             window_start, window_end = self._get_current_window(now_local)
             
-            self.logger.info(f"Processing leads for window: {window_start.strftime('%H:%M:%S')} - {window_end.strftime('%H:%M:%S')}")
+            self.logger.info("Processing leads for window: %s - %s", window_start.strftime('%H:%M:%S'), window_end.strftime('%H:%M:%S'))
 
-            # Get prioritized leads for this window
-            prioritized_leads = await self.get_prioritized_leads_for_window(window_start, window_end)
+            # This batch's own paging position through NEW leads (overlapping batches must not share one)
+            new_leads_cursor = PageCursor()
+            
+            # Get prioritized leads for this window, warming the Retell connection in parallel
+            prioritized_leads, _ = await asyncio.gather(
+                self.get_prioritized_leads_for_window(window_start, window_end, new_leads_cursor),
+                self.retell_service.warm_up()
+            )
             
             if not prioritized_leads:
                 self.logger.info("No leads available for calling in this window")
@@ -176,17 +286,37 @@ class LeadService:
             calls_made = await self._execute_calls_with_concurrency(
                 prioritized_leads, window_start, window_end
             )
+            total_leads_available = len(prioritized_leads)
+            
+            # Keep draining new leads page by page (cursor-based) while the window has time left;
+            # each page is streamed so dialing starts as soon as its first document arrives
+            while datetime.now(settings.app_timezone_obj) < window_end:
+                page_size = 0
+                
+                async def next_new_leads():
+                    nonlocal page_size
+                    async for lead in self.firebase_service.iter_new_leads(new_leads_cursor):
+                        _set_priority(lead, 4, 'new_lead')
+                        page_size += 1
+                        yield lead
+                
+                calls_made += await self._execute_calls_with_concurrency(
+                    next_new_leads(), window_start, window_end
+                )
+                if not page_size:
+                    break
+                total_leads_available += page_size
             
             return {
                 'status': 'completed',
                 'calls_made': calls_made,
-                'total_leads_available': len(prioritized_leads),
+                'total_leads_available': total_leads_available,
                 'window_start': window_start.isoformat(),
                 'window_end': window_end.isoformat()
             }
             
         except Exception as e:
-            self.logger.error(f"Error in calling batch execution: {str(e)}")
+            self.logger.error("Error in calling batch execution: %s", e)
             raise
     
     def _get_current_window(self, current_time: datetime) -> tuple[datetime, datetime]:
@@ -198,101 +328,79 @@ class LeadService:
         
         return window_start, window_end
 
-    async def _execute_calls_with_concurrency(self, leads: List[Lead], window_start: datetime, window_end: datetime) -> int:
-        """Execute calls while respecting concurrency limits and time window"""
+    async def _execute_calls_with_concurrency(self, leads: Union[Iterable[Lead], AsyncIterable[Lead]], window_start: datetime, window_end: datetime) -> int:
+        """Execute calls while respecting concurrency limits and time window (leads may be a list or an async stream)"""
         calls_made = 0
         
-        # Use a list to hold active call tasks, managing concurrency
-        active_call_tasks: List[asyncio.Task] = []
+        # The window end as a monotonic deadline: each check below is a float compare, not a tz-aware now()
+        loop = asyncio.get_running_loop()
+        now = loop.time
+        deadline = now() + (window_end - datetime.now(settings.app_timezone_obj)).total_seconds()
         
-        for lead in leads: 
-            # Check if window time has expired (using timezone-aware comparison)
-            if datetime.now(settings.app_timezone_obj) >= window_end: 
-                self.logger.info(f"Window time expired at {window_end.strftime('%H:%M:%S')}, stopping calls for this batch.")
-                break
-            
-            # Filter out leads that are not in a callable status
-            if lead.call_status not in [CallStatus.NEW, CallStatus.CALLBACK, CallStatus.RETRY]:
-                self.logger.debug(f"Lead {lead.id} has status {lead.call_status.value}. Skipping for calling batch.")
-                continue
-
-            # Check concurrency limit before initiating a new call
-            # Wait for any active call to finish if we hit the limit
-            while len(active_call_tasks) >= settings.max_concurrent_calls:
-                # Wait for the next task to complete
-                done, pending = await asyncio.wait(active_call_tasks, return_when=asyncio.FIRST_COMPLETED)
-                for task in done:
-                    active_call_tasks.remove(task)
-                    try:
-                        task.result() # Propagate exceptions if any
-                    except Exception as e:
-                        self.logger.error(f"An active call task failed: {e}")
-                
-                # Re-check window time after waiting
-                if datetime.now(settings.app_timezone_obj) >= window_end: 
-                    self.logger.info(f"Window time expired after waiting for concurrency, stopping calls.")
-                    break
-
-            if datetime.now(settings.app_timezone_obj) >= window_end: 
-                break # Break out of outer loop if window expired after waiting
-            
-            # Initiate the call and add to active tasks
-            task = asyncio.create_task(self._make_individual_call(lead))
-            active_call_tasks.append(task)
-            calls_made += 1 # Count as 'made' when initiated
-            
-            # Small delay between initiating calls to avoid overwhelming Retell or your network
-            await asyncio.sleep(0.5) 
+        # Producer/consumer: this loop feeds a bounded queue and max_concurrent_calls workers place the calls,
+        # and the producer blocks when the workers fall behind. The pool only bounds this batch; the cap across
+        # overlapping batches is the shared _call_semaphore in _make_individual_call
+        max_concurrent = settings.max_concurrent_calls
+        call_queue: asyncio.Queue = asyncio.Queue(maxsize=2 * max_concurrent)
         
-        # Wait for any remaining active calls to complete before returning
-        if active_call_tasks:
-            self.logger.info(f"Waiting for {len(active_call_tasks)} remaining calls to finish.")
-            await asyncio.gather(*active_call_tasks, return_exceptions=True) # Collect all results
+        async def _call_worker() -> None:
+            nonlocal calls_made
+            while True:
+                lead = await call_queue.get()
+                try:
+                    # Leads still queued when the window closes are left for the next window
+                    if now() < deadline:
+                        calls_made += 1 # Count as 'made' when initiated
+                        await self._make_individual_call(lead)
+                except Exception as e:
+                    self.logger.error("An active call task failed: %s", e)
+                finally:
+                    call_queue.task_done()
+        
+        workers = [asyncio.create_task(_call_worker()) for _ in range(max_concurrent)]
+        try:
+            async for lead in self._as_async_iter(leads): 
+                # Check if window time has expired
+                if now() >= deadline: 
+                    self.logger.info("Window time expired at %s, stopping calls for this batch.", window_end.strftime('%H:%M:%S'))
+                    break
+                
+                # Filter out leads that are not in a callable status
+                if lead.call_status not in _CALLABLE_STATUSES:
+                    self.logger.debug("Lead %s has status %s. Skipping for calling batch.", lead.id, lead.call_status.value)
+                    continue
+                
+                # Pace initiations to the Retell rate budget (bursts allowed until the bucket empties)
+                await self._dispatch_bucket.acquire()
+                await call_queue.put(lead)
+            
+            # Wait for queued and in-flight calls to finish before returning
+            await call_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-        self.logger.info(f"Completed calling batch: {calls_made} calls initiated in window.")
+        self.logger.info("Completed calling batch: %d calls initiated in window.", calls_made)
         return calls_made
     
-    async def _wait_for_available_slot(self, max_wait_seconds: int = 300) -> bool:
-        """
-        Wait for an available calling slot within concurrency limit from Retell API.
-        This method is less critical now that _execute_calls_with_concurrency
-        manages local task concurrency, but good for external API limits.
-        """
-        wait_start = datetime.now(settings.app_timezone_obj) 
-        
-        while (datetime.now(settings.app_timezone_obj) - wait_start).total_seconds() < max_wait_seconds: # Use total_seconds
-            concurrency_info = await self.retell_service.get_concurrency()
-            
-            if not concurrency_info:
-                self.logger.warning("Could not get concurrency info from Retell, retrying...")
-                await asyncio.sleep(10)
-                continue
-            
-            active_retell_calls = concurrency_info.get('active_calls', 0)
-            
-            # Here we check against Retell's backend limits, not just our local ones.
-            # You might have an even higher limit on Retell, or need to manage
-            # your account's rate limits.
-            # For simplicity, let's assume settings.max_concurrent_calls is the limit.
-            if active_retell_calls < settings.max_concurrent_calls: 
-                self.logger.info(f"Available Retell slot found. Active Retell calls: {active_retell_calls}/{settings.max_concurrent_calls}")
-                return True
-            
-            self.logger.info(f"Waiting for available Retell slot. Active Retell calls: {active_retell_calls}/{settings.max_concurrent_calls}")
-            await asyncio.sleep(10) # Wait 10 seconds before re-checking
-        
-        self.logger.error(f"Max wait time of {max_wait_seconds} seconds exceeded for Retell API slot.")
-        return False
-    
+    async def _as_async_iter(self, leads: Union[Iterable[Lead], AsyncIterable[Lead]]) -> AsyncIterator[Lead]:
+        """Iterate a plain list or an async lead stream the same way"""
+        if hasattr(leads, '__aiter__'):
+            async for lead in leads:
+                yield lead
+        else:
+            for lead in leads:
+                yield lead
+
     async def _make_individual_call(self, lead: Lead) -> bool: # Accept Lead object directly
         """Make a single call to a lead"""
         try:
-            # Update lead status to CALLING before initiating the call
-            await self.firebase_service.update_lead_status(lead.id, CallStatus.CALLING)
-            self.logger.info(f"Updated lead {lead.id} status to CALLING before call initiation.")
-
-            # assuming indian phone number, add +91 prefix
-            formatted_phone_number = f"+91{lead.phone_number}"
+            # Uploaded numbers are stored in E.164; older leads were stored as bare Indian numbers
+            if lead.phone_number.startswith('+'):
+                formatted_phone_number = lead.phone_number
+            else:
+                formatted_phone_number = f"+91{lead.phone_number}"
 
             # Create call request for Retell
             call_request = RetellCreateCallRequest(
@@ -307,43 +415,54 @@ class LeadService:
                 }
             )
             
-            # Make the call via RetellService
-            call_result = await self.retell_service.create_call(call_request)
+            # Make the call via RetellService; the service-wide semaphore keeps overlapping batches under Retell's limit
+            async with self._call_semaphore:
+                call_result = await self.retell_service.create_call(call_request)
             
             if call_result and call_result.get('call_id'): # Check for both result and call_id
-                # Update lead with Retell call ID. Status is already CALLING.
-                await self.firebase_service.update_lead(lead.id, {
+                # CALLING status, the Retell call ID and its call_index entry are written in one batch
+                await self.firebase_service.record_call(lead.id, call_result.get('call_id'), {
+                    **self.firebase_service.status_patch(CallStatus.CALLING),
                     'retell_call_id': call_result.get('call_id') 
                 })
                 
-                self.logger.info(f"Successfully initiated call for lead {lead.id} (Retell Call ID: {call_result.get('call_id')})")
+                self.logger.info("Successfully initiated call for lead %s (Retell Call ID: %s)", lead.id, call_result.get('call_id'))
                 return True
             else:
-                self.logger.error(f"Failed to create call for lead {lead.id}. Retell API response: {call_result}. Marking as FAILED.")
+                self.logger.error("Failed to create call for lead %s. Retell API response: %s. Marking as FAILED.", lead.id, call_result)
                 # If call initiation fails, mark as failed right away.
                 await self.firebase_service.update_lead_status(lead.id, CallStatus.FAILED)
                 return False
                 
         except Exception as e:
-            self.logger.error(f"Error making individual call for lead {lead.id}: {str(e)}")
+            self.logger.error("Error making individual call for lead %s: %s", lead.id, e)
             # In case of an unexpected error, mark as failed
             await self.firebase_service.update_lead_status(lead.id, CallStatus.FAILED)
             return False
 
     # --- CALL OUTCOME HANDLING ---
-    async def _handle_call_outcome(self, lead: Lead, disconnection_reason: str, post_call_data: Dict) -> None:
-        """Handle the outcome of a call and determine next steps based on post-call analysis."""
+    async def _handle_call_outcome(self, lead: Lead, disconnection_reason: str, post_call_data: Dict, call_patch: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Handle the outcome of a call and determine next steps based on post-call analysis.
+        call_patch (e.g. post_call_data) is merged into the status change so the lead is written once;
+        if the outcome can't be determined or written, call_patch is still written by itself.
+        """
+        firebase_service = self.firebase_service
+        
+        async def apply(outcome_patch: Dict[str, Any]) -> None:
+            await firebase_service.apply_lead_transition(lead.id, {**(call_patch or {}), **outcome_patch})
+        
         try:
             # Check for opt-out request first, as it's highest priority
             opt_out_requested = post_call_data.get('llm_dynamic_variables', {}).get('opt_out', False)
             if opt_out_requested:
-                await self.firebase_service.update_lead_status(lead.id, CallStatus.OPTED_OUT)
-                self.logger.info(f"Lead {lead.id} opted out and marked as {CallStatus.OPTED_OUT.value}.")
+                await apply(firebase_service.status_patch(CallStatus.OPTED_OUT))
+                self.logger.info("Lead %s opted out and marked as %s.", lead.id, CallStatus.OPTED_OUT.value)
                 return
 
             # If call was answered (user_hangup or agent_hangup)
             if disconnection_reason in [DisconnectionReason.USER_HANGUP.value, DisconnectionReason.AGENT_HANGUP.value]: 
-                self.logger.info(f"Call answered for lead {lead.id}, disconnection: {disconnection_reason}")
+                self.logger.info("Call answered for lead %s, disconnection: %s", lead.id, disconnection_reason)
                 
                 # Check for callback request (reschedule_time from Retell's post-call variables)
                 reschedule_time_str = post_call_data.get('llm_dynamic_variables', {}).get('reschedule_time') 
@@ -351,47 +470,50 @@ class LeadService:
                 if reschedule_time_str:
                     callback_time = self._parse_callback_time(reschedule_time_str)
                     if callback_time:
-                        await self.firebase_service.move_lead_to_callback(lead.id, callback_time)
-                        self.logger.info(f"Lead {lead.id} scheduled for callback at {callback_time}")
+                        await apply(firebase_service.callback_patch(callback_time))
+                        self.logger.info("Lead %s scheduled for callback at %s", lead.id, callback_time)
                         return
                 
                 # If no opt-out and no callback, then call completed successfully
-                self.logger.info(f"Lead {lead.id} call completed successfully, no callback/opt-out.")
-                await self.firebase_service.update_lead_status(lead.id, CallStatus.COMPLETED)
+                self.logger.info("Lead %s call completed successfully, no callback/opt-out.", lead.id)
+                await apply(firebase_service.status_patch(CallStatus.COMPLETED))
                 
             else:
                 # Call was not answered (busy, no_answer, voicemail, etc.)
-                self.logger.info(f"Call not answered for lead {lead.id}, disconnection: {disconnection_reason}")
+                self.logger.info("Call not answered for lead %s, disconnection: %s", lead.id, disconnection_reason)
                 
-                # Check retry attempts
-                if lead.number_of_retries < settings.max_retries:
-                    # Schedule for the next day, same time as current batch started
-                    retry_date = (datetime.now(settings.app_timezone_obj) + timedelta(days=1)).date() 
-                    await self.firebase_service.move_lead_to_retry(lead.id, lead.number_of_retries + 1, retry_date)
-                    self.logger.info(f"Lead {lead.id} scheduled for retry on {retry_date} (attempt {lead.number_of_retries + 1})")
+                # Retry count is read and incremented server-side so duplicate/concurrent webhooks can't overshoot max_retries
+                retry_date = (datetime.now(settings.app_timezone_obj) + timedelta(days=1)).date() 
+                scheduled, retries = await firebase_service.increment_retry_and_schedule(
+                    lead.id, settings.max_retries, retry_date, call_patch)
+                if scheduled:
+                    self.logger.info("Lead %s scheduled for retry on %s (attempt %s)", lead.id, retry_date, retries)
                 else:
-                    # Max retries reached
-                    await self.firebase_service.update_lead_status(lead.id, CallStatus.FAILED)
-                    self.logger.info(f"Lead {lead.id} marked as {CallStatus.FAILED.value} after {settings.max_retries} attempts")
+                    self.logger.info("Lead %s marked as %s after %s attempts", lead.id, CallStatus.FAILED.value, settings.max_retries)
             
         except Exception as e:
-            self.logger.error(f"Error handling call outcome for lead {lead.id}: {str(e)}")
+            self.logger.error("Error handling call outcome for lead %s: %s", lead.id, e)
+            if call_patch:
+                # The outcome wasn't written; still save the post-call data (transcript, analysis) on its own
+                try:
+                    await firebase_service.apply_lead_transition(lead.id, call_patch)
+                except Exception as save_error:
+                    self.logger.error("Error saving post-call data for lead %s: %s", lead.id, save_error)
             raise
 
     # --- UTILITY FUNCTIONS ---
     async def _find_lead_by_phone(self, phone_number: str) -> Optional[Lead]:
         """Find a lead by phone number in the main LEADS_COLLECTION."""
         try:
-            # This method in FirebaseService already handles the async.to_thread for stream()
             lead = await self.firebase_service.get_lead_by_phone_number(phone_number)
             if lead:
                 return lead
             
-            self.logger.info(f"No lead found for phone number: {phone_number}")
+            self.logger.info("No lead found for phone number: %s", phone_number)
             return None
             
         except Exception as e:
-            self.logger.error(f"Error finding lead by phone: {str(e)}")
+            self.logger.error("Error finding lead by phone: %s", e)
             raise
     
     def _is_calling_hours(self, current_time: datetime) -> bool: 
@@ -399,69 +521,46 @@ class LeadService:
         Check if current time (timezone-aware) is within calling hours.
         The current_time passed to this function *must* be timezone-aware.
         """
-        # Define start and end datetimes for today based on settings and current_time's date
-        start_of_calling_day = current_time.replace(
-            hour=settings.calling_start_hour, 
-            minute=0, 
-            second=0, 
-            microsecond=0
-        )
-        end_of_calling_day = current_time.replace(
-            hour=settings.calling_end_hour, 
-            minute=settings.calling_end_minute, 
-            second=0, 
-            microsecond=0
-        )
+        # Compare minutes since midnight instead of building start/end datetimes
+        current_minute = current_time.hour * 60 + current_time.minute
+        start_minute = settings.calling_start_hour * 60
+        end_minute = settings.calling_end_hour * 60 + settings.calling_end_minute # Inclusive of the end minute
         
-        # Adjust if end_hour is numerically smaller than start_hour (e.g., 10 AM to 2 AM next day)
-        # This case is unlikely with 10 AM to 11:30 PM, but good for robustness
-        if settings.calling_end_hour < settings.calling_start_hour:
-             # If end time is before start time (e.g., 10 PM - 6 AM), it spans two days.
-             # We assume calling_end_hour means end of the *next* day for such cases.
-             # For 10 AM - 11:30 PM, this block won't typically run as 23 > 10.
-            if current_time < start_of_calling_day: # e.g., 4 AM when start is 10 AM
-                # This could be the tail end of yesterday's calling hours
-                yesterday_end_of_calling_day = end_of_calling_day - timedelta(days=1)
-                return current_time >= yesterday_end_of_calling_day
+        if end_minute < start_minute:
+            # Calling hours span midnight (e.g. 10 PM - 6 AM)
+            is_within_hours = current_minute >= start_minute or current_minute <= end_minute
+        else:
+            is_within_hours = start_minute <= current_minute <= end_minute
         
-        # Simple check for cases where start <= end (e.g., 10 AM to 11:30 PM)
-        is_within_hours = (current_time >= start_of_calling_day) and \
-                          (current_time <= end_of_calling_day) # Use <= to include end minute
-                                                    
-        self.logger.debug(f"Calling hours check: Current {current_time.strftime('%H:%M')}, "
-                          f"Window: {start_of_calling_day.strftime('%H:%M')} - {end_of_calling_day.strftime('%H:%M')}. "
-                          f"Result: {is_within_hours}")
+        if self.logger.isEnabledFor(logging.DEBUG): # Skip building the message when debug is off
+            self.logger.debug(f"Calling hours check: Current {current_time.strftime('%H:%M')}, "
+                              f"Window: {start_minute // 60:02d}:{start_minute % 60:02d} - {end_minute // 60:02d}:{end_minute % 60:02d}. "
+                              f"Result: {is_within_hours}")
         return is_within_hours
 
     def _parse_callback_time(self, callback_time_str: str) -> Optional[datetime]:
         """Parse callback time string into datetime object, ensuring timezone awareness."""
         try:
-            # Try to parse common formats
-            for fmt in ['%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', 
-                        '%Y-%m-%dT%H:%M:%S.%f', '%H:%M']: # Added %H:%M for simple time
-                try:
-                    dt_obj = datetime.strptime(callback_time_str, fmt)
-                    # If only time was provided, assume today's date
-                    if fmt == '%H:%M':
-                        today = datetime.now(settings.app_timezone_obj)
-                        dt_obj = today.replace(hour=dt_obj.hour, minute=dt_obj.minute, 
-                                               second=0, microsecond=0)
-                    # Make it timezone-aware if not already (replace will add it if naive)
-                    if dt_obj.tzinfo is None:
-                        dt_obj = dt_obj.replace(tzinfo=settings.app_timezone_obj)
-                    return dt_obj
-                except ValueError:
-                    continue
-            
             # Handle relative terms like "tomorrow"
-            if callback_time_str.lower() in ['tomorrow', 'next day']:
+            if callback_time_str.lower() in _RELATIVE_CALLBACK_TERMS:
                 # For "tomorrow", set to a default time like 10 AM (start of business day) in the app's timezone
                 tomorrow = datetime.now(settings.app_timezone_obj) + timedelta(days=1)
                 return tomorrow.replace(hour=10, minute=0, second=0, microsecond=0)
             
-            self.logger.warning(f"Could not parse callback time string into datetime: '{callback_time_str}'")
+            parsed = _parse_callback_time_naive(callback_time_str)
+            if parsed is not None:
+                dt_obj, time_only = parsed
+                # If only time was provided, assume today's date
+                if time_only:
+                    today = datetime.now(settings.app_timezone_obj)
+                    return today.replace(hour=dt_obj.hour, minute=dt_obj.minute, 
+                                         second=0, microsecond=0)
+                # Make it timezone-aware (the parsed value is naive)
+                return dt_obj.replace(tzinfo=settings.app_timezone_obj)
+            
+            self.logger.warning("Could not parse callback time string into datetime: '%s'", callback_time_str)
             return None
             
         except Exception as e:
-            self.logger.error(f"Error parsing callback time '{callback_time_str}': {str(e)}")
+            self.logger.error("Error parsing callback time '%s': %s", callback_time_str, e)
             return None
\ No newline at end of file
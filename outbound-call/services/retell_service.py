@@ -1,12 +1,37 @@
 # services/retell_service.py
 import httpx # Import httpx instead of requests
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, Optional, Tuple
 from config.settings import settings
+from orjson import loads as _orjson_loads # Response bodies are decoded with orjson
+from pydantic import TypeAdapter
 from models.lead_models import RetellCreateCallRequest
-import json # Import json for JSON serialization
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Backoff for 429 responses: used when Retry-After is missing/unparseable, and the most we'll wait for one retry
+RETRY_AFTER_DEFAULT_SECONDS = 1.0
+RETRY_AFTER_MAX_SECONDS = 30.0
+
+# Largest Retell response body we'll buffer and parse (call details carry full transcripts)
+MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+
+# Built once: dump_json serializes a request straight to bytes (model_dump_json returns str, which we'd re-encode)
+_dump_call_request = TypeAdapter(RetellCreateCallRequest).dump_json
 
 class RetellService:
+    # Process-wide instance; see get_instance()
+    _instance: Optional["RetellService"] = None
+
+    @classmethod
+    def get_instance(cls) -> "RetellService":
+        """Return the shared RetellService, creating it (and its httpx connection pool) on first use"""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.base_url = settings.retell_base_url
@@ -19,93 +44,179 @@ class RetellService:
         # It's good practice to manage the client's lifecycle (e.g., with a context manager)
         # but for a simple service like this, initializing it in __init__ is often acceptable
         # if the service instance lives for the app's duration.
-        self._client = httpx.AsyncClient(headers=self.headers, base_url=self.base_url)
+        self._client = httpx.AsyncClient(
+            headers=self.headers,
+            base_url=self.base_url,
+            # Concurrent create-call requests multiplex over one TLS connection instead of one handshake each
+            http2=True,
+            # Bound the connection pool to the calling concurrency so bursts queue instead of opening sockets
+            limits=httpx.Limits(
+                max_connections=settings.max_concurrent_calls,
+                max_keepalive_connections=settings.max_concurrent_calls,
+                # Keep idle connections past short dispatch lulls instead of the 5s default
+                keepalive_expiry=60
+            ),
+            # create-call budget; fail fast if Retell can't even be reached (lookups pass their own shorter timeout)
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        )
     
-    # Add an async method to close the client when the application shuts down
+        # Stale-while-revalidate cache for get_concurrency: (fetched_at monotonic, response)
+        self._concurrency_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+        self._concurrency_refresh_task: Optional[asyncio.Task] = None
+    
+    # Must be called on application shutdown to release the pooled connections
     async def close(self):
         """Closes the httpx AsyncClient session."""
         await self._client.aclose()
         self.logger.info("httpx AsyncClient closed.")
 
+    async def warm_up(self) -> None:
+        """
+        Open (or refresh) the pooled connection to Retell before a batch starts dialing, so the first
+        create-call doesn't pay the TCP/TLS handshake. Uses the cached concurrency lookup; failures are ignored.
+        """
+        await self.get_concurrency()
+
     async def create_call(self, call_request: RetellCreateCallRequest) -> Optional[Dict[str, Any]]:
         """Create a new phone call via Retell API using httpx."""
         try:
-            # Get the raw dictionary representation of the Pydantic model
-            payload = call_request.model_dump(exclude_none=True)
+            # Serialize straight to JSON (custom_data was already stringified when the request model was built);
+            # the client's default headers already set Content-Type: application/json
+            body = _dump_call_request(call_request, exclude_none=True)
             
-            # Check if retell_llm_dynamic_variables exists and contains custom_data
-            if 'retell_llm_dynamic_variables' in payload and \
-               'custom_data' in payload['retell_llm_dynamic_variables']:
-                
-                custom_data_value = payload['retell_llm_dynamic_variables']['custom_data']
-                
-                # If custom_data is a dict (or anything not a string), convert it to JSON string
-                # This handles cases where custom_data might be None, an empty dict, or a populated dict
-                if not isinstance(custom_data_value, str):
-                    try:
-                        payload['retell_llm_dynamic_variables']['custom_data'] = json.dumps(custom_data_value)
-                    except TypeError:
-                        # Fallback if custom_data is not JSON serializable, send empty JSON string
-                        self.logger.warning(f"custom_data is not JSON serializable ({type(custom_data_value)}), sending empty JSON object as string: {custom_data_value}")
-                        payload['retell_llm_dynamic_variables']['custom_data'] = "{}"
-                
             # httpx.AsyncClient already has base_url configured, so just provide the path
-            response = await self._client.post("/v2/create-phone-call", json=payload, timeout=30)
+            response = await self._client.post("/v2/create-phone-call", content=body)
+            if response.status_code == 429:
+                # Over Retell's concurrency/rate limit: wait as instructed and try once more
+                delay = self._retry_after_seconds(response)
+                self.invalidate_concurrency_cache() # The cached headroom is evidently out of date
+                self.logger.warning("Retell rate limited create-call, retrying in %.1fs", delay)
+                await asyncio.sleep(delay)
+                response = await self._client.post("/v2/create-phone-call", content=body)
             
             response.raise_for_status() # Raise an exception for 4xx/5xx responses
             
-            result = response.json()
-            self.logger.info(f"Successfully created call: {result.get('call_id')}")
+            result = _orjson_loads(response.content)
+            self.logger.info("Successfully created call: %s", result.get('call_id'))
             return result
                 
         except httpx.HTTPStatusError as e:
-            self.logger.error(f"HTTP error creating call: {e.response.status_code} - {e.response.text}")
+            self.logger.error("HTTP error creating call: %s - %s", e.response.status_code, e.response.text)
             return None
         except httpx.RequestError as e:
-            self.logger.error(f"Network error creating call: {str(e)}")
+            self.logger.error("Network error creating call: %s", e)
             return None
         except Exception as e:
-            self.logger.error(f"Unexpected error creating call: {str(e)}")
+            self.logger.error("Unexpected error creating call: %s", e, exc_info=True)
             return None
     
+    def _retry_after_seconds(self, response: httpx.Response) -> float:
+        """Seconds to wait before retrying a 429 response (Retry-After as seconds or an HTTP date)"""
+        retry_after = response.headers.get('Retry-After')
+        delay = RETRY_AFTER_DEFAULT_SECONDS
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    pass
+        return min(max(delay, 0.0), RETRY_AFTER_MAX_SECONDS)
+
+    async def _read_capped(self, response: httpx.Response, max_bytes: int) -> bytes:
+        """Read a streamed response body, raising ValueError as soon as it exceeds max_bytes"""
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise ValueError(f"Retell response of {content_length} bytes exceeds the {max_bytes} byte limit")
+        chunks = []
+        received = 0
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            if received > max_bytes:
+                raise ValueError(f"Retell response exceeds the {max_bytes} byte limit")
+            chunks.append(chunk)
+        return b''.join(chunks)
+
     async def get_concurrency(self) -> Optional[Dict[str, Any]]:
+        """
+        Get current call concurrency information.
+        Fresh responses are served from cache; slightly stale ones are served while a background refresh runs.
+        Otherwise callers wait on a single shared refresh instead of each issuing their own request.
+        """
+        if self._concurrency_cache is not None:
+            fetched_at, cached = self._concurrency_cache
+            age = time.monotonic() - fetched_at
+            if age < settings.concurrency_fresh_seconds:
+                return cached
+            if age < settings.concurrency_stale_seconds:
+                self._start_concurrency_refresh()
+                return cached
+        
+        # shield: a cancelled caller must not cancel the refresh other callers are waiting on
+        return await asyncio.shield(self._start_concurrency_refresh())
+    
+    def _start_concurrency_refresh(self) -> asyncio.Task:
+        """Return the in-flight concurrency refresh, starting one if none is running"""
+        if self._concurrency_refresh_task is None or self._concurrency_refresh_task.done():
+            self._concurrency_refresh_task = asyncio.create_task(self._refresh_concurrency())
+        return self._concurrency_refresh_task
+    
+    def invalidate_concurrency_cache(self) -> None:
+        """Drop the cached concurrency so the next get_concurrency goes to Retell (e.g. after a 429)"""
+        self._concurrency_cache = None
+    
+    async def _refresh_concurrency(self) -> Optional[Dict[str, Any]]:
+        """Fetch concurrency from Retell and update the cache on success"""
+        result = await self._fetch_concurrency()
+        if result is not None:
+            self._concurrency_cache = (time.monotonic(), result)
+        return result
+    
+    async def _fetch_concurrency(self) -> Optional[Dict[str, Any]]:
         """Get current call concurrency information using httpx."""
         try:
             response = await self._client.get("/get-concurrency", timeout=10)
             
             response.raise_for_status() # Raise an exception for 4xx/5xx responses
             
-            result = response.json()
-            self.logger.debug(f"Current concurrency: {result}")
+            result = _orjson_loads(response.content)
+            self.logger.debug("Current concurrency: %s", result)
             return result
                 
         except httpx.HTTPStatusError as e:
-            self.logger.error(f"HTTP error getting concurrency: {e.response.status_code} - {e.response.text}")
+            self.logger.error("HTTP error getting concurrency: %s - %s", e.response.status_code, e.response.text)
             return None
         except httpx.RequestError as e:
-            self.logger.error(f"Network error getting concurrency: {str(e)}")
+            self.logger.error("Network error getting concurrency: %s", e)
             return None
         except Exception as e:
-            self.logger.error(f"Unexpected error getting concurrency: {str(e)}")
+            self.logger.error("Unexpected error getting concurrency: %s", e, exc_info=True)
             return None
     
     async def get_call_details(self, call_id: str) -> Optional[Dict[str, Any]]:
         """Get details of a specific call using httpx."""
         try:
-            response = await self._client.get(f"/get-call/{call_id}", timeout=10)
-            
-            response.raise_for_status() # Raise an exception for 4xx/5xx responses
+            # Streamed so an oversized body (e.g. a very long transcript) is rejected before it is buffered
+            async with self._client.stream("GET", f"/get-call/{call_id}", timeout=10) as response:
+                if response.is_error:
+                    await response.aread() # Error bodies are small; read them for the log below
+                    response.raise_for_status()
+                body = await self._read_capped(response, MAX_RESPONSE_BYTES)
             
-            result = response.json()
-            self.logger.info(f"Retrieved call details for: {call_id}")
+            result = _orjson_loads(body)
+            self.logger.info("Retrieved call details for: %s", call_id)
             return result
                 
         except httpx.HTTPStatusError as e:
-            self.logger.error(f"HTTP error getting call details: {e.response.status_code} - {e.response.text}")
+            self.logger.error("HTTP error getting call details: %s - %s", e.response.status_code, e.response.text)
             return None
         except httpx.RequestError as e:
-            self.logger.error(f"Network error getting call details: {str(e)}")
+            self.logger.error("Network error getting call details: %s", e)
+            return None
+        except ValueError as e: # Oversized body, or not valid JSON (orjson.JSONDecodeError is a ValueError)
+            self.logger.error("Invalid call details response for %s: %s", call_id, e)
             return None
         except Exception as e:
-            self.logger.error(f"Unexpected error getting call details: {str(e)}")
+            self.logger.error("Unexpected error getting call details: %s", e, exc_info=True)
             return None
\ No newline at end of file
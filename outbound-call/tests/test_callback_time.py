@@ -0,0 +1,36 @@
+# tests/test_callback_time.py
+import unittest
+from datetime import datetime
+from services.lead_service import _parse_callback_time_naive
+
+# Formats the original strptime loop accepted; the regex parser must accept all of them
+_STRPTIME_FORMATS = ['%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%H:%M']
+
+class ParseCallbackTimeTest(unittest.TestCase):
+    def test_single_digit_fields(self):
+        self.assertEqual(_parse_callback_time_naive('2024-1-5 9:30'), (datetime(2024, 1, 5, 9, 30), False))
+        self.assertEqual(_parse_callback_time_naive('2024-1-5T9:3:7'), (datetime(2024, 1, 5, 9, 3, 7), False))
+        self.assertEqual(_parse_callback_time_naive('09:5'), (datetime(1900, 1, 1, 9, 5), True))
+        self.assertEqual(_parse_callback_time_naive('9:30'), (datetime(1900, 1, 1, 9, 30), True))
+
+    def test_matches_strptime_formats(self):
+        for value in ['2024-01-05 09:30', '2024-1-5 9:30', '2024-01-05 09:30:15', '2024-1-5 9:3:5',
+                      '2024-01-05T09:30:15', '2024-01-05T09:30:15.25', '2024-01-05T9:30:15.123456', '09:30', '9:5']:
+            expected = None
+            for fmt in _STRPTIME_FORMATS:
+                try:
+                    expected = datetime.strptime(value, fmt)
+                    break
+                except ValueError:
+                    continue
+            self.assertIsNotNone(expected, value)
+            parsed = _parse_callback_time_naive(value)
+            self.assertIsNotNone(parsed, value)
+            self.assertEqual(parsed[0], expected, value)
+
+    def test_rejects_invalid(self):
+        for value in ['', 'tomorrow', '2024-13-01 09:30', '2024-01-05', '25:00', '9:60', '2024-01-05 093:00']:
+            self.assertIsNone(_parse_callback_time_naive(value), value)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,68 +1,156 @@
 # utils/csv_parser.py
-import pandas as pd
+import asyncio
+import csv
 import logging
-from typing import List, Dict, Any
-from io import StringIO
+from functools import partial
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+from typing import List, Dict, Any, AsyncIterator, BinaryIO, Optional, Tuple
+from utils.phone import normalize_phone_number
+
+class CSVParseError(ValueError):
+    """The CSV input is malformed; rows_read data rows were read before the error"""
+    def __init__(self, message: str, rows_read: int = 0):
+        super().__init__(message)
+        self.rows_read = rows_read
 
 class CSVParser:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
     
-    async def parse_csv_content(self, csv_content: str) -> List[Dict[str, Any]]:
-        """Parse CSV content and return list of dictionaries"""
+    async def parse_stream(self, file_obj: BinaryIO, required_fields: Optional[List[str]] = None,
+                           chunk_size: int = 500,
+                           skipped: Optional[List[Dict[str, Any]]] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Parse a binary CSV stream incrementally with pyarrow's streaming reader, yielding cleaned records in chunks.
+        Only one block of rows is held in memory at a time; parsing runs in a thread.
+        Phone numbers are normalized to E.164. Rows that are dropped (empty required fields, unparseable numbers)
+        are appended to `skipped` as {'reason', 'record'} if given; rows with the wrong number of columns
+        as {'reason': 'malformed_row', 'row_number', 'text'}.
+        Malformed input (bad header, invalid UTF-8, unparseable CSV) raises CSVParseError, possibly after some chunks were yielded.
+        """
+        required_fields = required_fields or []
+        rows_read = 0
         try:
-            # Read CSV content
-            df = pd.read_csv(StringIO(csv_content), dtype={'phone': str, 'phone_number': str, 'number': str, 'contact': str})
-            
-            # Clean column names (strip whitespace)
-            df.columns = df.columns.str.strip()
+            # Read the header ourselves so every column can be pinned to string (keeps leading zeros in phone numbers)
+            fieldnames = self.peek_header(file_obj)
+            if not fieldnames:
+                raise CSVParseError("CSV file is empty")
+            # pyarrow would silently keep only one of each repeated column
+            duplicate_fields = sorted({name for name in fieldnames if fieldnames.count(name) > 1})
+            if duplicate_fields:
+                raise CSVParseError(f"Duplicate column names in CSV header: {', '.join(duplicate_fields)}")
+            await asyncio.to_thread(file_obj.readline)
             
-            # Convert to list of dictionaries
-            records = df.to_dict('records')
+            missing_fields = [field for field in required_fields if field not in fieldnames]
+            if missing_fields:
+                raise CSVParseError(f"Missing required fields in CSV: {', '.join(missing_fields)}")
             
-            # Clean up None/NaN values
-            cleaned_records = []
-            for record in records:
-                cleaned_record = {k: (v if pd.notna(v) else '') for k, v in record.items()}
-                cleaned_records.append(cleaned_record)
+            # pyarrow refuses to open a stream with no data rows
+            data_start = file_obj.tell()
+            if not await asyncio.to_thread(file_obj.read, 1):
+                self.logger.info("CSV stream contains a header only, no records parsed")
+                return
+            file_obj.seek(data_start)
             
-            self.logger.info(f"Successfully parsed {len(cleaned_records)} records from CSV")
-            return cleaned_records
-            
-        except Exception as e:
-            self.logger.error(f"Error parsing CSV: {str(e)}")
-            raise
-    
-    async def parse_csv_file(self, file_path: str) -> List[Dict[str, Any]]:
-        """Parse CSV file and return list of dictionaries"""
-        try:
-            df = pd.read_csv(file_path)
-            df.columns = df.columns.str.strip()
+            reader = await asyncio.to_thread(
+                pa_csv.open_csv,
+                file_obj,
+                read_options=pa_csv.ReadOptions(column_names=fieldnames, block_size=1 << 20),
+                parse_options=pa_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=partial(self._skip_invalid_row, skipped)),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types={name: pa.string() for name in fieldnames},
+                    strings_can_be_null=False
+                )
+            )
             
-            records = df.to_dict('records')
-            cleaned_records = []
-            for record in records:
-                cleaned_record = {k: (v if pd.notna(v) else '') for k, v in record.items()}
-                cleaned_records.append(cleaned_record)
+            total_records = 0
+            skipped_records = 0
+            rejected_count = 0
+            while True:
+                batch = await asyncio.to_thread(next, reader, None)
+                if batch is None:
+                    break
+                rows_read += batch.num_rows
+                
+                # Required-field check runs on the column buffers, before any Python dicts are built
+                if required_fields:
+                    valid_mask = None
+                    for field in required_fields:
+                        field_mask = pc.greater(pc.utf8_length(batch.column(field)), 0)
+                        valid_mask = field_mask if valid_mask is None else pc.and_(valid_mask, field_mask)
+                    valid_batch = batch.filter(valid_mask)
+                    if valid_batch.num_rows < batch.num_rows:
+                        skipped_records += batch.num_rows - valid_batch.num_rows
+                        if skipped is not None:
+                            missing_records = await asyncio.to_thread(batch.filter(pc.invert(valid_mask)).to_pylist)
+                            skipped.extend({'reason': 'missing_required_fields', 'record': record} for record in missing_records)
+                    batch = valid_batch
+                
+                for offset in range(0, batch.num_rows, chunk_size):
+                    cleaned_records, rejected_records = await asyncio.to_thread(
+                        self._records_from_batch, batch.slice(offset, chunk_size)
+                    )
+                    if rejected_records:
+                        rejected_count += len(rejected_records)
+                        if skipped is not None:
+                            skipped.extend({'reason': 'invalid_phone_number', 'record': record} for record in rejected_records)
+                    if not cleaned_records:
+                        continue
+                    total_records += len(cleaned_records)
+                    yield cleaned_records
             
-            self.logger.info(f"Successfully parsed {len(cleaned_records)} records from file: {file_path}")
-            return cleaned_records
+            if skipped_records:
+                self.logger.warning("Skipped %d records missing required fields %s", skipped_records, required_fields)
+            if rejected_count:
+                self.logger.warning("Rejected %d records with invalid phone numbers", rejected_count)
+            self.logger.info("Successfully parsed %d records from CSV stream", total_records)
             
+        except CSVParseError as e:
+            self.logger.error("Error parsing CSV stream: %s", e)
+            raise
+        except (pa.ArrowInvalid, UnicodeDecodeError) as e:
+            # pyarrow reports both CSV syntax errors and invalid UTF-8 as ArrowInvalid
+            self.logger.error("Error parsing CSV stream after %d rows: %s", rows_read, e)
+            raise CSVParseError(str(e), rows_read) from e
         except Exception as e:
-            self.logger.error(f"Error parsing CSV file {file_path}: {str(e)}")
+            self.logger.error("Error parsing CSV stream: %s", e)
             raise
     
-    def validate_required_fields(self, records: List[Dict[str, Any]], required_fields: List[str]) -> bool:
-        """Validate that all records have required fields"""
+    def peek_header(self, file_obj: BinaryIO) -> List[str]:
+        """Return the stripped column names from the first line of a CSV stream without consuming it"""
+        start = file_obj.tell()
         try:
-            for i, record in enumerate(records):
-                for field in required_fields:
-                    if field not in record or not record[field]:
-                        self.logger.error(f"Missing required field '{field}' in record {i+1}")
-                        return False
-            
-            return True
-            
-        except Exception as e:
-            self.logger.error(f"Error validating CSV fields: {str(e)}")
-            return False
\ No newline at end of file
+            header_line = file_obj.readline()
+        finally:
+            file_obj.seek(start)
+        return [name.strip() for name in next(csv.reader([header_line.decode('utf-8-sig')]), [])]
+    
+    def _records_from_batch(self, batch) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Materialize a record batch and normalize phone numbers (blocking; run via asyncio.to_thread)"""
+        records = batch.to_pylist()
+        if 'phone_number' not in batch.schema.names:
+            return records, []
+        
+        cleaned_records = []
+        rejected_records = []
+        for record in records:
+            phone_number = normalize_phone_number(record['phone_number'])
+            if phone_number is None:
+                rejected_records.append(record)
+                continue
+            record['phone_number'] = phone_number
+            cleaned_records.append(record)
+        return cleaned_records, rejected_records
+    
+    def _skip_invalid_row(self, skipped: Optional[List[Dict[str, Any]]], row) -> str:
+        """
+        pyarrow invalid_row_handler (bound to a parse's skipped list): log, record and skip rows with the wrong
+        number of columns. row.number counts data rows only, so the header is added back to report the CSV row.
+        """
+        row_number = row.number + 1 if row.number is not None and row.number >= 0 else None
+        self.logger.warning("Skipping malformed CSV row %s: expected %s columns, got %s", row_number, row.expected_columns, row.actual_columns)
+        if skipped is not None:
+            skipped.append({'reason': 'malformed_row', 'row_number': row_number, 'text': row.text})
+        return 'skip'
@@ -0,0 +1,22 @@
+# utils/phone.py
+from typing import List, Optional
+import phonenumbers
+from config.settings import settings
+
+def normalize_phone_number(raw_number: str) -> Optional[str]:
+    """Normalize a phone number to E.164, assuming settings.default_phone_region for national numbers"""
+    try:
+        parsed = phonenumbers.parse(raw_number, settings.default_phone_region)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_possible_number(parsed):
+        return None
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+
+def legacy_phone_number_forms(e164_number: str) -> List[str]:
+    """
+    Forms an E.164 number may be stored under in leads created before numbers were normalized:
+    the E.164 string itself and the bare national number (e.g. '9876543210' for '+919876543210').
+    """
+    national_number = str(phonenumbers.parse(e164_number).national_number)
+    return [e164_number, national_number]
@@ -0,0 +1,29 @@
+# utils/rate_limiter.py
+import asyncio
+
+class TokenBucket:
+    """
+    Async token bucket: allows bursts of up to `capacity` acquisitions, then paces callers
+    to `refill_rate` tokens per second. Tokens are refilled lazily on each acquire.
+    """
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._updated_at = None
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, tokens: float = 1) -> None:
+        """Wait until `tokens` are available and take them"""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated_at is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.refill_rate)
+                self._updated_at = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                # Sleep just long enough for the missing tokens to refill (the lock keeps callers in order)
+                await asyncio.sleep((tokens - self._tokens) / self.refill_rate)
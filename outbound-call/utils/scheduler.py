@@ -1,45 +1,43 @@
 # utils/scheduler.py
+import asyncio
 import logging
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List
 from services.lead_service import LeadService
 from config.settings import settings
 
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, lock the file with msvcrt instead
+    fcntl = None
+    import msvcrt
+
 class CallScheduler:
-    def __init__(self):
+    def __init__(self, lead_service: LeadService):
         self.logger = logging.getLogger(__name__)
-        self.scheduler = AsyncIOScheduler()
-        self.lead_service = LeadService()
+        # One asyncio task per scheduled job; run times are computed in the app's timezone
+        # so they line up with the calling-hours check
+        self._tasks: List[asyncio.Task] = []
+        self.lead_service = lead_service
+        self._lock_file = None
     
     async def start_scheduler(self):
         """Start the scheduled calling jobs"""
         try:
-            # Schedule calling job every 10 minutes during business hours
-            self.scheduler.add_job(
-                func=self._execute_calling_job,
-                trigger=CronTrigger(
-                    minute=f"*/{settings.cron_interval_minutes}",
-                    hour=f"{settings.calling_start_hour}-{settings.calling_end_hour}",
-                    day_of_week="mon-fri"
-                ),
-                id='calling_job',
-                name='Execute Calling Batch',
-                misfire_grace_time=60,
-                coalesce=True,
-                max_instances=1
-            )
-            
-            # Schedule cleanup job daily at midnight
-            self.scheduler.add_job(
-                func=self._cleanup_old_records,
-                trigger=CronTrigger(hour=0, minute=0),
-                id='cleanup_job',
-                name='Daily Cleanup',
-                misfire_grace_time=300
-            )
+            # With several uvicorn workers only one process may place calls
+            if not self._acquire_leader_lock():
+                self.logger.info("Scheduler is running in another worker process; not starting it here")
+                return
             
-            self.scheduler.start()
+            self._tasks = [
+                # Calling job every cron_interval_minutes during business hours, Mon-Fri
+                asyncio.create_task(self._run_job('Execute Calling Batch', self._next_calling_time,
+                                                  self._execute_calling_job, misfire_grace_seconds=60)),
+                # Cleanup job daily at midnight
+                asyncio.create_task(self._run_job('Daily Cleanup', self._next_midnight,
+                                                  self._cleanup_old_records, misfire_grace_seconds=300)),
+            ]
             self.logger.info("Call scheduler started successfully")
             
         except Exception as e:
@@ -49,23 +47,94 @@ class CallScheduler:
     async def stop_scheduler(self):
         """Stop the scheduler"""
         try:
-            if self.scheduler.running:
-                self.scheduler.shutdown()
+            if self._tasks:
+                for task in self._tasks:
+                    task.cancel()
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+                self._tasks = []
                 self.logger.info("Call scheduler stopped")
         except Exception as e:
             self.logger.error(f"Error stopping scheduler: {str(e)}")
+        finally:
+            self._release_leader_lock()
     
-    async def _execute_calling_job(self):
-        """Execute the main calling job"""
+    def _acquire_leader_lock(self) -> bool:
+        """Take a non-blocking exclusive lock so a single worker runs the scheduled jobs"""
+        self._lock_file = open(settings.scheduler_lock_path, 'w')
         try:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                # Lock the first byte (locking past EOF is allowed); fails at once if another worker holds it
+                msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError: # BlockingIOError from flock, PermissionError from msvcrt
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+    
+    def _release_leader_lock(self):
+        """Release the scheduler lock (also released automatically if the process dies)"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+    
+    async def _run_job(self, name: str, next_run: Callable[[datetime], datetime],
+                       job: Callable[[datetime], Awaitable[None]], misfire_grace_seconds: float):
+        """
+        Run job(run_at) at each time returned by next_run, one run at a time. Run times that pass while the job
+        is still running are skipped, and a run is dropped if we wake more than misfire_grace_seconds late.
+        The job gets its scheduled run_at rather than reading the clock, so it always works on the intended tick.
+        """
+        while True:
+            run_at = next_run(datetime.now(settings.app_timezone_obj))
+            # The sleep runs on the monotonic clock, which can drift from wall time over long sleeps (e.g. the
+            # weekend gap): sleep again until the wall clock reaches run_at instead of running early.
+            # timestamp() honours the UTC offset at run_at, so DST changes don't skew the sleep
+            while (remaining := run_at.timestamp() - time.time()) > 0:
+                await asyncio.sleep(remaining)
+            lateness = time.time() - run_at.timestamp()
+            if lateness > misfire_grace_seconds:
+                self.logger.warning(f"Skipping '{name}' run scheduled for {run_at} ({lateness:.0f}s late)")
+                continue
+            try:
+                await job(run_at)
+            except Exception as e:
+                self.logger.error(f"Scheduled job '{name}' failed: {str(e)}")
+    
+    def _next_calling_time(self, now: datetime) -> datetime:
+        """Next minute after now matching minute */cron_interval_minutes, hours start-end, Mon-Fri"""
+        interval = settings.cron_interval_minutes
+        run_at = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        while True:
+            if run_at.weekday() >= 5 or not settings.calling_start_hour <= run_at.hour <= settings.calling_end_hour:
+                run_at = run_at.replace(minute=0) + timedelta(hours=1)
+            elif run_at.minute % interval:
+                # Past the last multiple in this hour this lands on the next hour's minute 0, like cron
+                run_at += timedelta(minutes=interval - run_at.minute % interval)
+            else:
+                return run_at
+    
+    def _next_midnight(self, now: datetime) -> datetime:
+        """Start of the next day in the app timezone"""
+        return datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=now.tzinfo)
+    
+    async def _execute_calling_job(self, run_at: datetime):
+        """Execute the main calling job for the tick scheduled at run_at"""
+        try:
+            # Idle ticks stop at one key-only read instead of running the batch's four lead queries
+            if not await self.lead_service.has_pending_leads():
+                self.logger.debug("No pending leads; skipping scheduled calling batch")
+                return
+            
             self.logger.info("Starting scheduled calling batch")
-            result = await self.lead_service.execute_calling_batch()
+            result = await self.lead_service.execute_calling_batch(run_at)
             self.logger.info(f"Calling batch completed: {result}")
             
         except Exception as e:
             self.logger.error(f"Error in scheduled calling job: {str(e)}")
     
-    async def _cleanup_old_records(self):
+    async def _cleanup_old_records(self, run_at: datetime):
         """Clean up old records and logs"""
         try:
             self.logger.info("Starting daily cleanup job")
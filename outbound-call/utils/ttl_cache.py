@@ -0,0 +1,56 @@
+# utils/ttl_cache.py
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+class SingleFlightTTL:
+    """
+    In-process TTL cache for async loaders.
+    Concurrent misses for the same key share one in-flight load instead of each hitting the upstream.
+    None results are treated as failures and are not cached.
+    With maxsize set, the oldest entries are evicted once the cache is full.
+    """
+    def __init__(self, ttl_seconds: float, maxsize: Optional[int] = None):
+        self.ttl_seconds = ttl_seconds
+        self.maxsize = maxsize
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}  # key -> (expires_at, value)
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+    
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value for key, loading it once via loader if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            self._in_flight[key] = task
+        
+        # Shield so one cancelled caller doesn't cancel the load for everyone else waiting on it
+        return await asyncio.shield(task)
+    
+    def put(self, key: Hashable, value: Any) -> None:
+        """Cache a value obtained elsewhere (e.g. as a by-product of another query); None is ignored"""
+        if value is None:
+            return
+        self._entries.pop(key, None)
+        if self.maxsize is not None and len(self._entries) >= self.maxsize:
+            # Dicts keep insertion order, so the first key is the oldest entry
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+    
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop a single cached key, or everything when key is None"""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+    
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await loader()
+            self.put(key, value)
+            return value
+        finally:
+            self._in_flight.pop(key, None)